@@ -19,18 +19,25 @@ from slicer.parameterNodeWrapper import (
 
 from slicer import vtkMRMLScalarVolumeNode, vtkMRMLMarkupsFiducialNode, vtkMRMLMarkupsNode
 
-try:
-    from OpenGL.GL import *
-except ImportError:
-    slicer.util.pip_install('PyOpenGL')
+import qt
 
 
-from AnatomyCarveLogic import *
-import numpy as np
-from AnatomyCarveLogic.Texture import *
-import vtkSegmentationCorePython as vtkSegmentationCore
-from vtk.util import numpy_support
-import qt
+def importLogic():
+    """Import the logic package, installing PyOpenGL first when it is missing.
+    Slicer imports this file at startup, PyOpenGL, NumPy and the logic are only loaded once the widget is set up.
+    """
+    try:
+        import OpenGL.GL
+    except ImportError:
+        slicer.util.pip_install("PyOpenGL")
+    import AnatomyCarveLogic
+    return AnatomyCarveLogic
+
+
+def clearGLError() -> None:
+    """Clear the GL error left by the event that triggered the callback."""
+    from OpenGL.GL import glGetError
+    glGetError()
 
 
 #
@@ -121,6 +128,8 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.logic = None
         self._parameterNode = None
         self._parameterNodeGuiTag = None
+        # Set while startRender runs, its progress callback processes events
+        self._preparingRender = False
 
     def setup(self) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
@@ -139,7 +148,7 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
         # Create logic class. Logic implements all computations that should be possible to run
         # in batch mode, without a graphical user interface.
-        self.logic = AnatomyCarveLogic()
+        self.logic = importLogic().AnatomyCarveLogic()
 
         # Connections
 
@@ -152,6 +161,9 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.renderButton.connect("clicked(bool)", self.onRenderButton)
         
         self.ui.sphereRadius.connect('valueChanged(double)', self.onSphereRadiusValueChanged)
+        # The proxy is carved while the radius slider is dragged
+        self.ui.sphereRadius.slider().connect('sliderPressed()', self.onSphereRadiusSliderPressed)
+        self.ui.sphereRadius.slider().connect('sliderReleased()', self.onSphereRadiusSliderReleased)
         
         #self.setupClippingSphereMarkups()
 
@@ -229,8 +241,7 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.tagPointRemovedEvent = node.AddObserver(vtkMRMLMarkupsNode.PointRemovedEvent , self.onPointRemovedEvent)
 
     def onPointAddedEvent(self, caller, eventId, callData=None):
-        # Clear error from event
-        err = glGetError()
+        clearGLError()
 
         # n = caller.GetNumberOfControlPoints()
         # updatedPoints = [tuple(caller.GetNthControlPointPosition(i)) for i in range(n)]
@@ -241,8 +252,7 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         
         
     def onPointRemovedEvent(self, caller, eventId, callData=None):
-        # Clear error from event
-        err = glGetError()
+        clearGLError()
 
         # n = caller.GetNumberOfControlPoints()
         # updatedPoints = [tuple(caller.GetNthControlPointPosition(i)) for i in range(n)]
@@ -257,8 +267,7 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             
         
     def onPointSelected(self, index):
-        # Clear error from event
-        err = glGetError()
+        clearGLError()
 
         #pass
         #print(index)
@@ -269,11 +278,16 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         #slicer.util.getNode("Clipping sphere").AddObserver(vtkMRMLMarkupsNode.PointPositionDefinedEvent, self.onPointEvent)
     
     def onSphereRadiusValueChanged(self, newSphereRadius: float):
-        # Clear error from event
-        err = glGetError()
+        clearGLError()
 
         self.logic.updateClippingSphereRadius(newSphereRadius)        
         
+    def onSphereRadiusSliderPressed(self):
+        self.logic.beginInteraction()
+
+    def onSphereRadiusSliderReleased(self):
+        self.logic.endInteraction()
+
     def selectRow(self, row: int):
         
         if row == -1:
@@ -368,7 +382,7 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                self._parameterNode.view = firstViewNode
 
 
-    def setParameterNode(self, inputParameterNode: Optional[AnatomyCarveParameterNode]) -> None:
+    def setParameterNode(self, inputParameterNode: Optional["AnatomyCarveParameterNode"]) -> None:
         """
         Set and observe parameter node.
         Observation is needed because when the parameter node is changed then the GUI must be updated immediately.
@@ -410,10 +424,16 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     #                                self.ui.imageThresholdSliderWidget.value, not self.ui.invertOutputCheckBox.checked, showResult=False)
                 
     def _checkCanRender(self, caller=None, event=None) -> None:
-        if self._parameterNode and self._parameterNode.intensityVolume and self._parameterNode.segmentation and self._parameterNode.view:
+        if self._preparingRender:
+            self.ui.renderButton.toolTip = _("Preparing volumes...")
+            self.ui.renderButton.enabled = False
+        elif self._parameterNode and self._parameterNode.intensityVolume and self._parameterNode.segmentation and self._parameterNode.view:
             if not hasattr(self.logic, 'context'):
                 self.ui.renderButton.toolTip = _("Start AnatomyCarve rendering")
                 self.ui.renderButton.enabled = True
+            elif getattr(self.logic, 'segmentLabelsOutdated', False):
+                self.ui.renderButton.toolTip = _("Segments changed, render again to carve them")
+                self.ui.renderButton.enabled = True
             else:            
                 self.ui.renderButton.toolTip = _("Rendering already started")
                 self.ui.renderButton.enabled = False
@@ -423,11 +443,26 @@ class AnatomyCarveWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     def onRenderButton(self) -> None:
         """Run processing when user clicks "Render" button."""
-        err = glGetError()
-
-        with slicer.util.tryWithErrorDisplay(_("Failed to start rendering."), waitCursor=True):            
-            self.setupClippingSphereMarkups()
-            self.logic.startRender(self.clippingSpheresNode)
+        clearGLError()
+
+        # The volumes are prepared on worker threads, the dialog keeps processing events while they run
+        progressDialog = slicer.util.createProgressDialog(labelText=_("Preparing volumes..."), maximum=100)
+        # Render cannot be clicked again from the processed events until startRender returns
+        self._preparingRender = True
+        self._checkCanRender()
+
+        def onProgress(message: str, fraction: float) -> None:
+            progressDialog.labelText = message
+            progressDialog.value = int(fraction * 100)
+            slicer.app.processEvents()
+
+        try:
+            with slicer.util.tryWithErrorDisplay(_("Failed to start rendering."), waitCursor=True):
+                self.setupClippingSphereMarkups()
+                self.logic.startRender(self.clippingSpheresNode, onProgress)
+        finally:
+            self._preparingRender = False
+            progressDialog.close()
             self._checkCanRender()
             
 
@@ -452,6 +487,18 @@ class AnatomyCarveTest(ScriptedLoadableModuleTest):
         """Run as few or as many tests as needed here."""
         self.setUp()
         self.test_AnatomyCarve1()
+        self.setUp()
+        self.test_CarveTracker()
+        self.setUp()
+        self.test_CpuCarver()
+        self.setUp()
+        self.test_MaskPacking()
+        self.setUp()
+        self.test_LabelRemapping()
+        self.setUp()
+        self.test_BrickOrigins()
+        self.setUp()
+        self.test_VolumeCache()
 
     def test_AnatomyCarve1(self):
         """Ideally you should have several levels of tests.  At the lowest level
@@ -485,7 +532,7 @@ class AnatomyCarveTest(ScriptedLoadableModuleTest):
 
         # Test the module logic
 
-        logic = AnatomyCarveLogic()
+        logic = importLogic().AnatomyCarveLogic()
 
         # # Test algorithm with non-inverted threshold
         # logic.process(inputVolume, outputVolume, threshold, True)
@@ -500,3 +547,230 @@ class AnatomyCarveTest(ScriptedLoadableModuleTest):
         # self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
         self.delayDisplay("Test passed")
+
+    def test_CarveTracker(self):
+        """Regions returned by CarveTracker.update. A voxel outside of them is not carved again, a missing
+        region leaves stale voxels in the output.
+        """
+
+        self.delayDisplay("Starting the CarveTracker test")
+
+        import numpy as np
+
+        logic = importLogic()
+        tracker = logic.CarveTracker((32, 32, 32))
+        modelMatrix = np.eye(4)
+        spheres = np.array([[8.0, 8.0, 8.0, 3.0], [20.0, 20.0, 20.0, 2.0]], dtype=np.float32)
+
+        # Nothing was carved yet, then nothing changed
+        self.assertEqual(tracker.update(spheres, modelMatrix, set(), 0), [tracker.fullRegion()])
+        self.assertEqual(tracker.update(spheres, modelMatrix, set(), 0), [])
+
+        # The box around the old position is restored and the one around the new position carved, both padded
+        # by the anti-aliasing samples
+        movedSpheres = spheres.copy()
+        movedSpheres[1, :3] = (24.0, 22.0, 20.0)
+        self.assertEqual(tracker.update(movedSpheres, modelMatrix, set(), 0), [((17, 17, 17), (7, 7, 7)), ((21, 19, 17), (7, 7, 7))])
+
+        # The mask row of a sphere changed, its box is carved again although it did not move
+        self.assertEqual(tracker.update(movedSpheres, modelMatrix, {0}, 1), [((4, 4, 4), (9, 9, 9))])
+
+        # Boxes are clipped to the volume
+        movedSpheres[0, :3] = (1.0, 30.0, 16.0)
+        self.assertEqual(tracker.update(movedSpheres, modelMatrix, set(), 1), [((4, 4, 4), (9, 9, 9)), ((0, 26, 12), (6, 6, 9))])
+
+        # Every voxel moves with the volume
+        movedMatrix = np.eye(4)
+        movedMatrix[0, 3] = 1.0
+        self.assertEqual(tracker.update(movedSpheres, movedMatrix, set(), 1), [tracker.fullRegion()])
+
+        self.delayDisplay("Test passed")
+
+    def test_CpuCarver(self):
+        """Label dilation and carving of CpuCarver, the reference the GPU passes are compared with."""
+
+        self.delayDisplay("Starting the CpuCarver test")
+
+        import numpy as np
+
+        logic = importLogic()
+        # Two boxes of labels 2 and 1 separated by the x = 8 plane
+        labels = np.zeros((16, 16, 16), dtype=np.uint16)
+        labels[4:12, 4:12, 2:8] = 2
+        labels[4:12, 4:12, 9:14] = 1
+        colorMap = np.array([[0, 0, 0, 0], [255, 0, 0, 255], [0, 255, 0, 255]], dtype=np.uint8)
+        intensity = np.full(labels.shape, 0.5, dtype=np.float32)
+        carver = logic.CpuCarver(labels, colorMap, intensity, workers=2)
+
+        dilated = carver.dilateLabels()
+        # Labelled voxels keep their label, the background only takes labels from its 3x3x3 neighbourhood
+        self.assertTrue(np.array_equal(dilated[labels != 0], labels[labels != 0]))
+        self.assertEqual(dilated[8, 8, 1], 2)
+        self.assertEqual(dilated[0, 0, 0], 0)
+        # Both labels are seen 9 times from the x = 8 plane, the tie goes to the first neighbour of the shader
+        # loops (dx = -1), not to the smallest label
+        self.assertEqual(dilated[8, 8, 8], 2)
+
+        # Sphere 0 carves label 2 around (4, 8, 8), sphere 1 covers label 1 without carving it
+        spheres = np.array([[4.0, 8.0, 8.0, 3.0], [11.0, 8.0, 8.0, 2.0]], dtype=np.float32)
+        mask = np.array([[1, 1, 0], [1, 1, 1]], dtype=np.uint8)
+        out = carver.carve(mask, spheres, np.eye(4))
+
+        self.assertEqual(out[8, 8, 4].tolist(), [0.0, 1.0, 0.0, 0.0])
+        self.assertEqual(out[8, 8, 11].tolist(), [1.0, 0.0, 0.0, 0.5])
+        self.assertEqual(out[8, 8, 8].tolist(), [0.0, 1.0, 0.0, 0.5])
+        self.assertEqual(out[0, 0, 0].tolist(), [0.0, 0.0, 0.0, 0.0])
+        # 2 of the 5 anti-aliasing samples of the voxel on the sphere are inside
+        self.assertAlmostEqual(float(out[8, 8, 7, 3]), 0.5 * 3.0 / 5.0, places=6)
+
+        self.delayDisplay("Test passed")
+
+    def test_MaskPacking(self):
+        """Bit layout of the carve mask buffer read by CarveVoxelsAA.comp, and the words written by Mask.flush."""
+
+        self.delayDisplay("Starting the mask packing test")
+
+        import numpy as np
+
+        logic = importLogic()
+        # Bit i of word [w * labelCount + label] is set when sphere 32 * w + i carves the label
+        rows = np.ones((35, 3), dtype=np.uint8)
+        rows[0, 2] = 0
+        rows[31, 1] = 0
+        rows[33, 2] = 0
+        self.assertEqual(logic.Mask.packRows(rows, 2).ravel().tolist(), [0, 0x80000000, 1, 0, 0, 2])
+        # The spheres missing from the last word carve nothing
+        self.assertEqual(logic.Mask.packRows(rows[:1], 1).ravel().tolist(), [0, 0, 1])
+
+        # The GPU buffer is written from the CPU rows, flush uploads the words changed since the last flush
+        slicer.app.layoutManager().threeDWidget(0).threeDView().renderWindow().MakeCurrent()
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+        for labelValue in (1, 2):
+            segmentID = segmentationNode.GetSegmentation().AddEmptySegment()
+            segmentationNode.GetSegmentation().GetSegment(segmentID).SetLabelValue(labelValue)
+        mask = logic.Mask(segmentationNode, 0, logic.Context.buildLabelLookup(segmentationNode))
+        mask.writeRow(33, np.array([1, 1, 0]))
+        mask.writeRow(70, np.array([1, 0, 1]))
+        # Unchanged rows are not dirty
+        mask.writeRow(71, np.ones(3))
+        self.assertEqual(mask.popDirtyRows(), {33, 70})
+        self.assertEqual(mask.dirtyWords, {1, 2})
+        mask.flush()
+        self.assertEqual(mask.dirtyWords, set())
+        # Sphere 33 is bit 1 of word 1, sphere 70 bit 6 of word 2
+        self.assertEqual(mask.buffer.read(0, 9).tolist(), [0, 0, 0, 0, 0, 2, 0, 64, 0])
+        mask.release()
+
+        self.delayDisplay("Test passed")
+
+    def test_LabelRemapping(self):
+        """Dense labels of Context, which index the label volume, the mask and the color table."""
+
+        self.delayDisplay("Starting the label remapping test")
+
+        import numpy as np
+
+        logic = importLogic()
+        lookup = np.zeros(301, dtype=np.uint16)
+        lookup[[4, 9, 300]] = [1, 2, 3]
+        labels = np.array([[[0, 4, 9], [300, 7, 400]]], dtype=np.uint16)
+        remapped = logic.Context.remapLabels(labels, lookup, np.uint8)
+        self.assertEqual(remapped.dtype, np.uint8)
+        # Label values without a segment, inside or beyond the lookup, become background
+        self.assertEqual(remapped.tolist(), [[[0, 1, 2], [3, 0, 0]]])
+
+        # Segment label values are remapped to 1..N in increasing order
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+        segmentationNode.CreateDefaultDisplayNodes()
+        segmentation = segmentationNode.GetSegmentation()
+        for labelValue, color in ((9, (1.0, 0.0, 0.0)), (4, (0.0, 1.0, 0.0))):
+            segmentation.GetSegment(segmentation.AddEmptySegment("", "", color)).SetLabelValue(labelValue)
+        lookup = logic.Context.buildLabelLookup(segmentationNode)
+        self.assertEqual(lookup.tolist(), [0, 0, 0, 0, 1, 0, 0, 0, 0, 2])
+
+        # The color table keeps the dense labels it was built with when a segment is added
+        colors = [[0, 0, 0, 0], [0, 255, 0, 255], [255, 0, 0, 255]]
+        self.assertEqual(logic.Context.buildLabelToColorMap(segmentationNode, lookup)[:, 0].tolist(), colors)
+        segmentation.GetSegment(segmentation.AddEmptySegment("", "", (0.0, 0.0, 1.0))).SetLabelValue(2)
+        self.assertEqual(logic.Context.buildLabelToColorMap(segmentationNode, lookup)[:, 0].tolist(), colors)
+
+        self.delayDisplay("Test passed")
+
+    def test_BrickOrigins(self):
+        """Bricks of Context.buildBrickOrigins, the only bricks carved once the empty space is cleared."""
+
+        self.delayDisplay("Starting the brick origins test")
+
+        import numpy as np
+
+        logic = importLogic()
+        labels = np.zeros((10, 9, 20), dtype=np.uint8)
+        self.assertEqual(logic.Context.buildBrickOrigins(labels, 8).shape, (0, 4))
+
+        # A label one voxel before a brick boundary also occupies the next brick through the dilation
+        labels[0, 0, 7] = 1
+        # Partial bricks at the end of each axis are kept
+        labels[9, 4, 19] = 2
+        origins = logic.Context.buildBrickOrigins(labels, 8)
+        self.assertEqual(origins.dtype, np.int32)
+        self.assertEqual(origins.tolist(), [[0, 0, 0, 0], [8, 0, 0, 0], [16, 0, 8, 0]])
+
+        self.delayDisplay("Test passed")
+
+    def test_VolumeCache(self):
+        """Round trip, keys and least recently used eviction of VolumeCache in a temporary directory."""
+
+        self.delayDisplay("Starting the volume cache test")
+
+        import os
+        import tempfile
+        import numpy as np
+
+        logic = importLogic()
+        volume = np.arange(2 * 3 * 4, dtype=np.uint16).reshape(2, 3, 4)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = logic.VolumeCache(directory)
+            key = cache.hashKey("labels", volume)
+            self.assertIsNone(cache.load(key, "labels"))
+            cache.save(key, "labels", volume)
+            loaded = cache.load(key, "labels")
+            self.assertEqual(loaded.dtype, volume.dtype)
+            np.testing.assert_array_equal(loaded, volume)
+            self.assertFalse(loaded.flags.writeable)
+            # Written slice by slice
+            with cache.writer(key, "slices", volume.shape, volume.dtype) as write:
+                for volumeSlice in volume:
+                    write(volumeSlice)
+            np.testing.assert_array_equal(cache.load(key, "slices"), volume)
+            del loaded
+
+        # Keys depend on the content, type and shape of arrays and on the boundaries between parts
+        self.assertEqual(logic.VolumeCache.hashKey("labels", volume), logic.VolumeCache.hashKey("labels", volume.copy()))
+        changedVolume = volume.copy()
+        changedVolume[1, 2, 3] += 1
+        keys = {
+            logic.VolumeCache.hashKey("labels", volume),
+            logic.VolumeCache.hashKey("labels", changedVolume),
+            logic.VolumeCache.hashKey("labels", volume.astype(np.int16)),
+            logic.VolumeCache.hashKey("labels", volume.reshape(4, 3, 2)),
+            logic.VolumeCache.hashKey("intensity", volume),
+        }
+        self.assertEqual(len(keys), 5)
+        self.assertNotEqual(logic.VolumeCache.hashKey("ab", "c"), logic.VolumeCache.hashKey("a", "bc"))
+
+        entry = np.zeros(1000, dtype=np.uint8)
+        with tempfile.TemporaryDirectory() as directory:
+            # Room for two entries
+            cache = logic.VolumeCache(directory, maxBytes=2500)
+            for name, lastUse in (("a", 1000), ("b", 2000)):
+                cache.save(name, "volume", entry)
+                os.utime(cache.entryPath(name), (lastUse, lastUse))
+            # Loading "a" makes "b" the least recently used entry
+            cache.load("a", "volume")
+            cache.save("c", "volume", entry)
+            self.assertEqual(sorted(key for _, _, key in cache.entries()), ["a", "c"])
+            # The entry just written is kept even when it is larger than the cache
+            cache.save("d", "volume", np.zeros(4000, dtype=np.uint8))
+            self.assertEqual([key for _, _, key in cache.entries()], ["d"])
+
+        self.delayDisplay("Test passed")
@@ -1,8 +1,9 @@
+import json
 import logging
 import os
 import time
 
-from typing import Annotated, Optional
+from typing import Annotated, Callable, Optional
 
 import vtk
 
@@ -14,6 +15,7 @@ from slicer.util import VTKObservationMixin
 from slicer.parameterNodeWrapper import (
     parameterNodeWrapper,
     WithinRange,
+    Choice,
 )
 
 from slicer import vtkMRMLScalarVolumeNode, vtkMRMLSegmentationNode, vtkMRMLViewNode, vtkMRMLMarkupsFiducialNode
@@ -25,6 +27,12 @@ from AnatomyCarveLogic.Texture import *
 from AnatomyCarveLogic.Context import *
 from vtk.util import numpy_support
 from AnatomyCarveLogic.ComputeShader import *
+from AnatomyCarveLogic.CarveTracker import *
+from AnatomyCarveLogic.CarveTarget import *
+from AnatomyCarveLogic.GpuTimer import *
+from AnatomyCarveLogic.Profiler import *
+from AnatomyCarveLogic.StorageBuffer import *
+from AnatomyCarveLogic.VolumeCache import *
 
 # from qt import QOpenGLWidget
 # from OpenGL.GL import glIsTexture
@@ -46,8 +54,17 @@ class AnatomyCarveLogic(ScriptedLoadableModuleLogic):
     def __init__(self) -> None:
         """Called when the logic class is instantiated. Can be used for initializing member variables."""
         ScriptedLoadableModuleLogic.__init__(self)
-        self.shaderFillColorVolume = ComputeShader("FillColorVolume.comp")
-        self.shaderCarveVoxels = ComputeShader("CarveVoxelsAA.comp")
+        # The shaders depend on the texture formats of the context, they are compiled in startRender
+        self.shaderDilateLabels = None
+        self.shaderCarveVoxels = None
+        # Reference dilation kernel, only compiled by benchmarkDilation
+        self.shaderFillColorVolume = None
+        # Only compiled when the interaction proxy is first built
+        self.shaderDownsampleVolume = None
+        # Set by enableProfiling, times the compute passes on the GPU
+        self.gpuTimer = None
+        # Set while an InteractionTrace records the session
+        self.interactionTrace = None
 
     def getParameterNode(self):
         return AnatomyCarveParameterNode(super().getParameterNode())
@@ -90,50 +107,220 @@ class AnatomyCarveLogic(ScriptedLoadableModuleLogic):
     #     stopTime = time.time()
     #     logging.info(f"Processing completed in {stopTime-startTime:.2f} seconds")
 
-    def startRender(self, clippingSpheresNode: vtkMRMLMarkupsFiducialNode) -> None:
+    def startRender(self, clippingSpheresNode: vtkMRMLMarkupsFiducialNode, progress: Optional[Callable[[str, float], None]] = None) -> None:
         self.node: AnatomyCarveParameterNode = self.getParameterNode()
         self.clippingSpheresNode = clippingSpheresNode
 
-        self.context = Context(self.node.intensityVolume, self.node.segmentation, self.node.view)
+        self.removeSegmentationObservers()
+        self.removeInteractionObservers()
+        self.removeCarveObserver()
+        self.releaseResources()
+        # Derived volumes of inputs seen before are read from the cache instead of being rebuilt
+        cache = VolumeCache.default() if self.node.useVolumeCache else None
+        with Profiler.phase("Context"):
+            self.context = Context(self.node.intensityVolume, self.node.segmentation, self.node.view, self.node.outputFormat, self.node.intensityFormat, cache, progress)
+        with Profiler.phase("compileShaders"):
+            # Only compiled when the dilated labels are not cached, see applyDilateLabelsComputeShader
+            self.shaderDilateLabels = None
+            self.shaderFillColorVolume = None
+            self.shaderDownsampleVolume = None
+            self.shaderCarveVoxels = self.createComputeShader("CarveVoxelsAA.comp", {
+                "OUTPUT_FORMAT": self.context.outputImageFormat(),
+                "INTENSITY_FORMAT": self.context.intensityImageFormat(),
+                "LABEL_FORMAT": self.context.labelImageFormat(),
+                "BRICK_SIZE": Context.BRICK_SIZE,
+            })
+        self.groupsPerBrick = int(np.prod([Context.BRICK_SIZE // size for size in self.shaderCarveVoxels.workGroupSize()]))
+        self.context.outputTarget.setGroupsPerBrick(self.groupsPerBrick)
+        # Low resolution proxy carved and shown instead of the output during interactions, built at the first one
+        self.proxyDownsampling = self.node.proxyDownsampling
+        self.proxyTarget = None
+        self.interacting = False
+        # Set once the segments differ from those the label volume was built from, see onSegmentsModified
+        self.segmentLabelsOutdated = False
+        # Carves go to back textures and reach the output once finished, renders do not wait for them
+        self.asyncCarve = self.node.asyncCarve
+        self.addSegmentationObservers()
+        self.addInteractionObservers()
+        self.sphereBuffer = StorageBuffer(np.float32, 4 * Mask.INITIAL_SPHERE_CAPACITY)
         self.addInitialClippingSphere()
-        self.applyFillColorComputeShader()
+        if not self.context.labelVolumeDilatedLoaded:
+            with Profiler.phase("dilateLabels"):
+                self.applyDilateLabelsComputeShader()
+                self.context.saveDilatedLabels()
         self.applyCarveVoxelsComputeShader()
 
-        
+    def releaseResources(self):
+        # GL objects of the previous startRender, every Render click creates new ones
+        for shader in self.getComputeShaders():
+            shader.release()
+        self.shaderDilateLabels = None
+        self.shaderCarveVoxels = None
+        self.shaderFillColorVolume = None
+        self.shaderDownsampleVolume = None
+        if getattr(self, 'sphereBuffer', None) is not None:
+            self.sphereBuffer.release()
+            self.sphereBuffer = None
+        if self.gpuTimer is not None:
+            # Only the query objects, the samples are kept and the next passes create new queries
+            self.gpuTimer.release()
+        if hasattr(self, 'context'):
+            if getattr(self, 'proxyTarget', None) is not None:
+                self.context.releaseProxyTarget(self.proxyTarget)
+                self.proxyTarget = None
+            self.context.release()
+            # Nothing reaches the released textures while the next Context is prepared, or if preparing it fails
+            del self.context
+
+    def createComputeShader(self, computeShaderPath: str, defines: Optional[dict] = None) -> ComputeShader:
+        shader = ComputeShader(computeShaderPath, defines)
+        shader.timer = self.gpuTimer
+        return shader
+
+    def getComputeShaders(self) -> list:
+        shaders = [self.shaderDilateLabels, self.shaderCarveVoxels, self.shaderFillColorVolume, self.shaderDownsampleVolume]
+        return [shader for shader in shaders if shader is not None]
+
+    def enableProfiling(self, enabled: bool = True, gpuTimingsCsvPath: Optional[str] = None):
+        # Phase timings and GL traffic counters (see Profiler), and GPU timings of every compute pass,
+        # optionally appended to a CSV file as they are read back
+        Profiler.enable(enabled)
+        if self.gpuTimer is not None:
+            self.gpuTimer.release()
+        self.gpuTimer = GpuTimer(gpuTimingsCsvPath) if enabled else None
+        for shader in self.getComputeShaders():
+            shader.timer = self.gpuTimer
+
+    def getGpuTimings(self) -> dict:
+        # last, mean and 95th percentile GPU time of every compute pass, in milliseconds
+        if self.gpuTimer is None:
+            return {}
+        self.gpuTimer.collect()
+        return self.gpuTimer.stats()
+
+    def getProfile(self) -> dict:
+        profile = Profiler.asDict()
+        profile["gpu"] = self.getGpuTimings()
+        return profile
+
+    def saveProfile(self, path: str):
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump(self.getProfile(), f, indent=2)
+
+
+    def addSegmentationObservers(self):
+        # The selected mask row follows the segment visibility, it is only rebuilt when the display node changes
+        segmentationNode = self.context.segmentation
+        segmentation = segmentationNode.GetSegmentation()
+        self.segmentationObservations = [
+            (segmentationNode.GetDisplayNode(), segmentationNode.GetDisplayNode().AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSegmentationDisplayModified)),
+        ] + [
+            (segmentation, segmentation.AddObserver(event, self.onSegmentsModified))
+            for event in (slicer.vtkSegmentation.SegmentAdded, slicer.vtkSegmentation.SegmentRemoved, slicer.vtkSegmentation.SegmentModified)
+        ]
+
+    def removeSegmentationObservers(self):
+        for observedObject, tag in getattr(self, 'segmentationObservations', []):
+            observedObject.RemoveObserver(tag)
+        self.segmentationObservations = []
+
+    def onSegmentsModified(self, caller, event):
+        self.context.mask.updateSegmentIndex()
+        if not self.segmentLabelsOutdated and self.context.segmentLabelsChanged():
+            # The segments of startRender keep being carved with their colors, the widget enables Render again
+            self.segmentLabelsOutdated = True
+            logging.warning("Segments were added, removed or relabelled since rendering started, click Render to carve them")
+            self.node.parameterNode.Modified()
+        self.onSegmentationDisplayModified(caller, event)
+
+    def onSegmentationDisplayModified(self, caller, event):
+        mask = self.context.mask
+        generation = mask.generation
+        mask.updateSelectedRowFromSegmentation()
+        # Colors are read from the small color table by the carve pass, a color change only re-uploads it
+        if self.context.updateLabelToColorMap():
+            for target in self.getCarveTargets():
+                target.recarveOccupiedBricks()
+            self.scheduleRender()
+        elif mask.generation != generation:
+            self.scheduleRender()
+
+    def addInteractionObservers(self):
+        # Dragging a sphere carves the proxy, the output is carved again when the sphere is released
+        self.interactionObservations = [
+            (self.clippingSpheresNode, self.clippingSpheresNode.AddObserver(vtkMRMLMarkupsFiducialNode.PointStartInteractionEvent, lambda caller, event: self.beginInteraction())),
+            (self.clippingSpheresNode, self.clippingSpheresNode.AddObserver(vtkMRMLMarkupsFiducialNode.PointEndInteractionEvent, lambda caller, event: self.endInteraction())),
+        ]
+
+    def removeInteractionObservers(self):
+        for observedObject, tag in getattr(self, 'interactionObservations', []):
+            observedObject.RemoveObserver(tag)
+        self.interactionObservations = []
+
+    def recordInteraction(self, eventType: str, **data):
+        if self.interactionTrace is not None:
+            self.interactionTrace.record(eventType, **data)
+
+    def beginInteraction(self):
+        self.recordInteraction("beginInteraction")
+        # Until endInteraction, the ticks carve the proxy. A downsampling of 1 disables the proxy.
+        if not hasattr(self, 'context') or self.proxyDownsampling <= 1 or self.interacting:
+            return
+        self.interacting = True
+        self.scheduleRender()
+
+    def endInteraction(self):
+        self.recordInteraction("endInteraction")
+        if not hasattr(self, 'context') or not self.interacting:
+            return
+        self.interacting = False
+        # The output is carved with the latest spheres by the tick of this render, before it is drawn
+        self.context.outputTarget.setVisible(True)
+        if self.proxyTarget is not None:
+            self.proxyTarget.setVisible(False)
+        self.scheduleRender()
+
+    def getCarveTargets(self) -> list:
+        return [self.context.outputTarget] + ([self.proxyTarget] if self.proxyTarget is not None else [])
+
+    def getActiveCarveTarget(self) -> CarveTarget:
+        if not self.interacting:
+            target = self.context.outputTarget
+        else:
+            if self.proxyTarget is None:
+                self.proxyTarget = self.context.createProxyTarget(self.proxyDownsampling)
+                self.proxyTarget.setGroupsPerBrick(self.groupsPerBrick)
+                self.applyDownsampleComputeShader(self.proxyTarget)
+            # Transparent until carved, the output stays visible until then
+            self.proxyTarget.setVisible(True)
+            target = self.proxyTarget
+        # The asynchronous carves of the other target are not polled anymore, they are copied now
+        for inactiveTarget in self.getCarveTargets():
+            if inactiveTarget is not target:
+                inactiveTarget.flushCopies()
+        return target
+
     def changeSelctedPointIndex(self, newSelectedPointIndex):
+        self.recordInteraction("selectSphere", index=newSelectedPointIndex)
         self.context.mask.selectSphere(newSelectedPointIndex)
-        #self.context.mask.updateSelectedRowFromSegmentation()
         
         sphereRadiusesList = list(self.sphereRadiuses)
         return self.sphereRadiuses[sphereRadiusesList[newSelectedPointIndex]]
 
 
     def addLastClippingSphere(self, sphereRadius: int):
-        #print(updatedPoints)
-        # print(self.context.mask.texture.readRow2d(0))
-
-        
-        # err = glGetError()
-        # # if err == GL_INVALID_VALUE:
-        # #     print("Detected GL_INVALID_VALUE (1281); dumping Python stack:")
-        # #     traceback.print_stack()
-        
-        
-        # # find the QOpenGLWidget inside the 3D view
-        # threeDView = slicer.app.layoutManager().threeDWidget(0).threeDView()
-        # glWidget = threeDView.findChildren(QOpenGLWidget)[0]
-
-        # # 1. Bind its context + FBO
-        # glWidget.makeCurrent()
-        
-        
         lastIndex = self.clippingSpheresNode.GetNumberOfControlPoints() - 1
         self.sphereRadiuses[self.clippingSpheresNode.GetNthControlPointID(lastIndex)] = sphereRadius
         self.context.mask.addSphere()
+        if self.interactionTrace is not None:
+            position = [0.0, 0.0, 0.0]
+            self.clippingSpheresNode.GetNthControlPointPosition(lastIndex, position)
+            self.recordInteraction("addSphere", position=position, radius=sphereRadius)
         
         return self.context.mask.selectedSphereIndex
 
     def removeLastClippingSphere(self):
+        self.recordInteraction("removeSphere")
         self.context.mask.removeSphere()
         
         sphereRadiusesList = list(self.sphereRadiuses)
@@ -160,6 +347,7 @@ class AnatomyCarveLogic(ScriptedLoadableModuleLogic):
             return
         
         self.sphereRadiuses[sphereRadiusesList[self.context.mask.selectedSphereIndex]] = newSphereRadius
+        self.recordInteraction("sphereRadius", radius=newSphereRadius)
         
         self.forceRender()
     
@@ -207,116 +395,133 @@ class AnatomyCarveLogic(ScriptedLoadableModuleLogic):
         # displayNode.SetTextScale(1.5)
         # self.carvingSphere = carvingSphere
 
-    def applyFillColorComputeShader(self):
-        
-        shader = self.shaderFillColorVolume
-
-        # Get the render window from the 3D viewer
-        renderWindow = slicer.app.layoutManager().threeDWidget(self.context.getViewIndex()).threeDView().renderWindow()
+    def applyDilateLabelsComputeShader(self):
+        if self.shaderDilateLabels is None:
+            self.shaderDilateLabels = self.createComputeShader("DilateLabels.comp", {
+                "LABEL_FORMAT": self.context.labelImageFormat(),
+            })
+        shader = self.shaderDilateLabels
 
         glUseProgram(shader.program)
         shader.bindTexture(0, self.context.labelVolumeTex3d, GL_READ_ONLY)
-        shader.bindTexture(1, self.context.labelToColorMapTex2d, GL_READ_ONLY)
-        shader.bindTexture(2, self.context.labelToColorVolumeTex3d, GL_WRITE_ONLY)
-        shader.bindTexture(3, self.context.labelVolumeDilatedTex3d, GL_WRITE_ONLY)
-        glUniform1f(glGetUniformLocation(shader.program, "scale"), 0.00025)
-        glUniform1i(glGetUniformLocation(shader.program, "colorMapSize"), self.context.labelToColorMapTex2d.dims[0])
-        # print(self.context.labelToColorVolumeTex3d.dims)
-        shader.dispatch(self.context.labelToColorVolumeTex3d.dims)
+        shader.bindTexture(1, self.context.labelVolumeDilatedTex3d, GL_WRITE_ONLY)
+        shader.dispatch(self.context.labelVolumeDilatedTex3d.dims)
         glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
 
-    def applyCarveVoxelsComputeShader(self):
-        
-
-        renderWindow = slicer.app.layoutManager().threeDWidget(self.context.getViewIndex()).threeDView().renderWindow()
-        
-        observerTag = renderWindow.AddObserver(vtk.vtkCommand.StartEvent, self.applyCarveVoxelsComputeShaderTick)
-
-    def applyCarveVoxelsComputeShaderTick(self, caller, event):
-
-        # # # find the QOpenGLWidget inside the 3D view
-        # # # 1. Grab a specific 3D view (here: the first one)
-        # # view = slicer.app.layoutManager().threeDWidget(0).threeDView()
-        # # rw = view.renderWindow()
-
-        # # #print(rw)
-
-        # # #print("VTK GetGenericContext:", rw.GetGenericContext())
-        # # #print("VTK GenericDrawableHandle:", rw.GetGenericDrawableHandle())
-
-        # # # 2. Tell VTK to always re-bind this context, even if it thinks it’s already current
-        # # rw.SetForceMakeCurrent()
-
-        # # # 3. Make that context current on this thread
-        # # rw.MakeCurrent()
-
-        # # #print("VTK GetGenericContext:", rw.GetGenericContext())
-        # # #print("VTK GenericDrawableHandle:", rw.GetGenericDrawableHandle())
-
-
-
-        # # # first, make sure the Slicer view’s context is bound:
-        # # view = slicer.app.layoutManager().threeDWidget(0).threeDView()
-        # # rw = view.renderWindow()
-        # # rw.SetForceMakeCurrent()
-        # # rw.MakeCurrent()
-
-        # # # now grab the native GL context handle
-        # # ctx = None
-        # # if sys.platform == 'win32':
-        # #     # on Windows: HGLRC from wglGetCurrentContext()
-        # #     from OpenGL.WGL import wglGetCurrentContext
-        # #     ctx = wglGetCurrentContext()
-        # # elif sys.platform.startswith('linux'):
-        # #     # on X11/Linux: GLXContext* from glXGetCurrentContext()
-        # #     from OpenGL.GLX import glXGetCurrentContext
-        # #     ctx = glXGetCurrentContext()
-        # # elif sys.platform == 'darwin':
-        # #     # on macOS: CGLContextObj from CGLGetCurrentContext()
-        # #     from OpenGL.CGL import CGLGetCurrentContext
-        # #     ctx = CGLGetCurrentContext()
-        # # else:
-        # #     print(f"Unsupported platform: {sys.platform}")
+    def applyFillColorComputeShader(self, labelVolumeDilatedTex3d: Optional[Texture] = None):
+        # Reference dilation kernel, one thread per voxel doing 27 image loads
+        if self.shaderFillColorVolume is None:
+            self.shaderFillColorVolume = self.createComputeShader("FillColorVolume.comp", {
+                "LABEL_FORMAT": self.context.labelImageFormat(),
+            })
+        shader = self.shaderFillColorVolume
+        if labelVolumeDilatedTex3d is None:
+            labelVolumeDilatedTex3d = self.context.labelVolumeDilatedTex3d
 
-        # #print("Current native OpenGL context handle:", ctx)
+        glUseProgram(shader.program)
+        shader.bindTexture(0, self.context.labelVolumeTex3d, GL_READ_ONLY)
+        shader.bindTexture(3, labelVolumeDilatedTex3d, GL_WRITE_ONLY)
+        shader.dispatch(labelVolumeDilatedTex3d.dims)
+        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
 
-        # print(glGetError())       
+    def applyDownsampleComputeShader(self, proxyTarget: CarveTarget):
+        if self.shaderDownsampleVolume is None:
+            self.shaderDownsampleVolume = self.createComputeShader("DownsampleVolume.comp", {
+                "LABEL_FORMAT": self.context.labelImageFormat(),
+                "INTENSITY_FORMAT": self.context.intensityImageFormat(),
+            })
+        shader = self.shaderDownsampleVolume
 
-        # # (make sure you’ve already done rw.MakeCurrent() on your vtk render window…)
+        glUseProgram(shader.program)
+        glUniform1i(glGetUniformLocation(shader.program, "factor"), self.proxyDownsampling)
+        shader.bindTexture(0, self.context.labelVolumeDilatedTex3d, GL_READ_ONLY)
+        shader.bindTexture(1, self.context.intensityVolumeTex3d, GL_READ_ONLY)
+        shader.bindTexture(2, proxyTarget.labelVolumeDilatedTex3d, GL_WRITE_ONLY)
+        shader.bindTexture(3, proxyTarget.intensityVolumeTex3d, GL_WRITE_ONLY)
+        shader.dispatch(proxyTarget.labelVolumeDilatedTex3d.dims)
+        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
 
-        # # get the raw context handle
-        # if sys.platform == 'win32':
-        #     from OpenGL.WGL import wglGetCurrentContext
-        #     current = wglGetCurrentContext()
-        # elif sys.platform.startswith('linux'):
-        #     from OpenGL.GLX import glXGetCurrentContext
-        #     current = glXGetCurrentContext()
-        # elif sys.platform == 'darwin':
-        #     from OpenGL.CGL import CGLGetCurrentContext
-        #     current = CGLGetCurrentContext()
-        # else:
-        #     raise RuntimeError(f"Unsupported platform: {sys.platform}")
+    def benchmarkDilation(self, repeats: int = 5) -> dict:
+        # Times the tiled dilation against the reference kernel on the current label volume and checks
+        # that both produce the same dilated labels. Must be called after startRender.
+        dilated = self.context.labelVolumeDilatedTex3d
+        reference = Texture()
+        reference.allocate(dilated.dims, dilated.internalformat, dilated.format, dilated.type)
+
+        def averageSeconds(apply):
+            apply()
+            glFinish()
+            startTime = time.perf_counter()
+            for _ in range(repeats):
+                apply()
+            glFinish()
+            return (time.perf_counter() - startTime) / repeats
+
+        referenceSeconds = averageSeconds(lambda: self.applyFillColorComputeShader(reference))
+        tiledSeconds = averageSeconds(self.applyDilateLabelsComputeShader)
+        identical = np.array_equal(reference.readData3d(), dilated.readData3d())
+        glDeleteTextures(1, [reference.textureId])
+
+        result = {
+            "dims": tuple(dilated.dims),
+            "referenceSeconds": referenceSeconds,
+            "tiledSeconds": tiledSeconds,
+            "speedup": referenceSeconds / tiledSeconds if tiledSeconds > 0 else float("inf"),
+            "identical": identical,
+        }
+        logging.info(f"Label dilation {result['dims']}: reference {referenceSeconds * 1000:.1f} ms, tiled {tiledSeconds * 1000:.1f} ms, identical: {identical}")
+        return result
 
-        # print("Current context handle:", current)
+    def applyCarveVoxelsComputeShader(self):
+        
 
+        renderWindow = slicer.app.layoutManager().threeDWidget(self.context.getViewIndex()).threeDView().renderWindow()
+        
+        self.carveObservation = (renderWindow, renderWindow.AddObserver(vtk.vtkCommand.StartEvent, self.applyCarveVoxelsComputeShaderTick))
 
+    def removeCarveObserver(self):
+        observation = getattr(self, 'carveObservation', None)
+        if observation is not None:
+            observedObject, tag = observation
+            observedObject.RemoveObserver(tag)
+        self.carveObservation = None
 
+    def applyCarveVoxelsComputeShaderTick(self, caller, event):
+        with Profiler.phase("carveTick"):
+            self.carveActiveTarget()
 
+    def carveActiveTarget(self):
         # Clear error from event
         err = glGetError()
 
-        self.context.updateOutputVolumeTextureId()
+        if self.gpuTimer is not None:
+            self.gpuTimer.collect()
 
-        shader = self.shaderCarveVoxels
-
-        modelMatrix = vtk.vtkMatrix4x4()
-        self.context.outputVolume.GetIJKToRASMatrix(modelMatrix)
+        target = self.getActiveCarveTarget()
+        try:
+            outputTextureChanged = target.updateOutputVolumeTextureId(self.context.getViewIndex())
+        except RuntimeError as e:
+            # Not recoverable by later renders, carving stops until the next startRender
+            logging.error(str(e))
+            self.removeCarveObserver()
+            return
+        if outputTextureChanged:
+            target.invalidate()
+        if not target.isOutputTextureValid():
+            # VTK creates the proxy texture when the proxy is first rendered, it is carved by the next tick
+            if target is self.proxyTarget:
+                self.scheduleRender()
+            return
+        # The proxy is carved below, before this render draws it instead of the output
+        if target is self.proxyTarget:
+            self.context.outputTarget.setVisible(False)
+        # Carves of earlier ticks that finished are shown by this render, the others are polled by the next one
+        if self.asyncCarve and target.resolveCopies():
+            self.scheduleRender()
 
-        gl_mat = np.zeros(16, dtype=np.float32)
+        shader = self.shaderCarveVoxels
 
-        for col in range(4):
-            for row in range(4):
-                gl_mat[col * 4 + row] = modelMatrix.GetElement(row, col)
+        modelMatrix = target.getIJKToRASMatrix()
 
         sphereDetailsArray = []
         for i in range(self.clippingSpheresNode.GetNumberOfControlPoints()):
@@ -326,27 +531,52 @@ class AnatomyCarveLogic(ScriptedLoadableModuleLogic):
             sphereDetailsArray.append(spherePosRadius)
         
         sphereDetails = np.array(sphereDetailsArray, dtype=np.float32)
+
+        # Only the boxes around spheres that moved, resized or changed their mask row need carving
+        mask = self.context.mask
+        with Profiler.phase("maskSync"):
+            dirtyRows = mask.popDirtyRows()
+            for carveTarget in self.getCarveTargets():
+                carveTarget.addDirtyRows(dirtyRows)
+            regions = target.carveTracker.update(sphereDetails, slicer.util.arrayFromVTKMatrix(modelMatrix), target.popDirtyRows(), mask.generation)
+
+        # Nothing changed since the last carve (e.g. the camera is rotated), the output texture is still valid
+        if not regions:
+            Profiler.count("skippedFrames")
+            return
         
-        self.context.mask.updateSelectedRowFromSegmentation()
-        
-        #self.context.mask.texture.readRow2d(0)
+        gl_mat = np.zeros(16, dtype=np.float32)
 
-        # print(self.clipMask.shape[0])
+        for col in range(4):
+            for row in range(4):
+                gl_mat[col * 4 + row] = modelMatrix.GetElement(row, col)
 
-        glUseProgram(shader.program)
-        glUniform4fv(glGetUniformLocation(shader.program, "sphereDetails"), 32, sphereDetails)
-        glUniform1i(glGetUniformLocation(shader.program, "sphereCount"), self.context.mask.sphereCount)
-        #glUniform1iv(glGetUniformLocation(shader.program, "clipMask"), self.clipMask.shape[0], self.clipMask)
-        glUniformMatrix4fv(glGetUniformLocation(shader.program, "modelMatrix"), 1, GL_FALSE, gl_mat)
-        shader.bindTexture(0, self.context.outputVolumeTex3d, GL_READ_WRITE)
-        shader.bindTexture(1, self.context.labelVolumeDilatedTex3d, GL_READ_ONLY)
-        shader.bindTexture(2, self.context.intensityVolumeTex3d, GL_READ_ONLY)
-        shader.bindTexture(3, self.context.mask.texture, GL_READ_ONLY)
-        shader.bindTexture(4, self.context.labelToColorVolumeTex3d, GL_READ_ONLY)
-
-        shader.dispatch(self.context.labelToColorVolumeTex3d.dims)
-        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
+        with Profiler.phase("maskSync"):
+            self.sphereBuffer.upload(sphereDetails)
+            self.context.mask.flush()
+
+        with Profiler.phase("uniformSetup"):
+            glUseProgram(shader.program)
+            glUniform1i(glGetUniformLocation(shader.program, "sphereCount"), self.context.mask.sphereCount)
+            glUniform1i(glGetUniformLocation(shader.program, "labelCount"), self.context.mask.labelCount)
+            glUniformMatrix4fv(glGetUniformLocation(shader.program, "modelMatrix"), 1, GL_FALSE, gl_mat)
+            shader.bindTexture(4, self.context.labelToColorMapTex2d, GL_READ_ONLY)
+            shader.bindBuffer(0, self.sphereBuffer)
+            shader.bindBuffer(1, self.context.mask.buffer)
+
+        # All the dispatches of the tick are timed as one pass, the proxy separately from the output
+        timed = self.gpuTimer is not None and self.gpuTimer.begin(shader.name if target is self.context.outputTarget else shader.name + "Proxy")
+        target.carve(shader, regions, self.asyncCarve)
+        if timed:
+            self.gpuTimer.end()
+        if self.asyncCarve:
+            # This render still draws the previous result, the next one polls the fence of this carve
+            self.scheduleRender()
         
+    def scheduleRender(self):
+        viewIndex = self.context.getViewIndex()
+        slicer.app.layoutManager().threeDWidget(viewIndex).threeDView().scheduleRender()
+
     def forceRender(self):
         viewIndex = self.context.getViewIndex()
         slicer.app.layoutManager().threeDWidget(viewIndex).threeDView().renderWindow().Render()
@@ -403,6 +633,11 @@ class AnatomyCarveParameterNode:
     intensityVolume: vtkMRMLScalarVolumeNode
     segmentation: vtkMRMLSegmentationNode
     view: vtkMRMLViewNode
+    outputFormat: Annotated[str, Choice(list(Context.OUTPUT_FORMATS))] = Context.DEFAULT_OUTPUT_FORMAT
+    intensityFormat: Annotated[str, Choice(list(Context.INTENSITY_FORMATS))] = Context.DEFAULT_INTENSITY_FORMAT
+    proxyDownsampling: Annotated[int, WithinRange(1, 4)] = 2
+    asyncCarve: bool = False
+    useVolumeCache: bool = True
     # inputVolume: vtkMRMLScalarVolumeNode
     # imageThreshold: Annotated[float, WithinRange(-100, 500)] = 100
     # invertThreshold: bool = False
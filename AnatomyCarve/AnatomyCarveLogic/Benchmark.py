@@ -0,0 +1,487 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+# Aliased, the star imports of OpenGL.GL shadow the platform module
+import platform as platformInfo
+import subprocess
+import sys
+import time
+import numpy as np
+
+from OpenGL.GL import *
+
+import vtk
+
+from typing import List, Optional
+
+from AnatomyCarveLogic.Texture import *
+from AnatomyCarveLogic.StorageBuffer import *
+from AnatomyCarveLogic.ComputeShader import *
+from AnatomyCarveLogic.Context import *
+from AnatomyCarveLogic.Mask import *
+from AnatomyCarveLogic.CarveTarget import *
+from AnatomyCarveLogic.CarveTracker import *
+from AnatomyCarveLogic.CpuCarver import *
+from AnatomyCarveLogic.Profiler import *
+
+# Headless carving benchmark on synthetic volumes. Builds the textures of Context from generated arrays
+# instead of MRML nodes, so it runs without views, e.g. from Slicer's Python with an offscreen context:
+#   Slicer --no-main-window --python-code "from AnatomyCarveLogic.Benchmark import Benchmark; Benchmark.main(['--sizes', '128', '256'])"
+# Results are JSON files, Benchmark.compare() reports the metrics that regressed between two of them.
+# Benchmark.verify() (or --verify for every case) checks the GPU carve against CpuCarver.
+class Benchmark:
+    RESULTS_VERSION = 1
+    ENGINES = ("gl", "cpu")
+    DEFAULT_SIZES = (128, 256)
+    DEFAULT_LABEL_COUNTS = (10, 100, 1000)
+    DEFAULT_SPHERE_COUNTS = (1, 8, 32)
+    DEFAULT_TICKS = 30
+    WARMUP_TICKS = 3
+    # Labelled fraction of the volume, the rest is background like the air around a body
+    BODY_RADIUS = 0.45
+    # Sphere radius and distance moved by the dragged sphere per tick, relative to the volume size
+    SPHERE_RADIUS = 0.08
+    DRAG_STEP = 0.01
+    # Metrics where a larger value is worse, compared by compare(). startupSeconds only covers building the carve data
+    # from arrays (texture upload only for gl): the labelmap export, output volume and cache of Context are not timed.
+    COMPARED_METRICS = ("startupSeconds", "dilateSeconds", "fullCarveMs", "tickMeanMs", "tickP95Ms", "peakRssBytes")
+    STARTUP_LABELS = {"gl": "texture upload only", "cpu": "array preparation only"}
+    DEFAULT_TOLERANCE = 0.1
+    # Small case carved by verify() on the GPU and with CpuCarver
+    VERIFY_CASE = {"size": 40, "labelCount": 20, "sparseLabels": True, "sphereCount": 8}
+    # Bytes per texel of the texture formats used by Context
+    TEXEL_BYTES = {
+        GL_R8UI: 1,
+        GL_R16UI: 2,
+        GL_R8: 1,
+        GL_R16: 2,
+        GL_R32F: 4,
+        GL_RGBA8: 4,
+        GL_RGBA16: 8,
+        GL_RGBA32F: 16,
+    }
+
+    @staticmethod
+    def buildCases(sizes=DEFAULT_SIZES, labelCounts=DEFAULT_LABEL_COUNTS, sparseLabels=(False, True), sphereCounts=DEFAULT_SPHERE_COUNTS) -> List[dict]:
+        # Smallest volumes first, the peak RSS of the process only grows
+        return [
+            {"size": size, "labelCount": labelCount, "sparseLabels": sparse, "sphereCount": sphereCount}
+            for size, labelCount, sparse, sphereCount in itertools.product(sorted(sizes), labelCounts, sparseLabels, sphereCounts)
+        ]
+
+    @staticmethod
+    def caseName(engine: str, case: dict) -> str:
+        labels = "sparse" if case["sparseLabels"] else "dense"
+        return f"{engine}-{case['size']}-{case['labelCount']}{labels}-{case['sphereCount']}spheres"
+
+    @staticmethod
+    def labelValues(labelCount: int, sparseLabels: bool, rng: np.random.Generator) -> np.ndarray:
+        # Segment label values: 1..N, or N values spread over the whole uint16 range
+        if not sparseLabels:
+            return np.arange(1, labelCount + 1, dtype=np.uint16)
+        return np.sort(rng.choice(np.arange(1, 65536), size=labelCount, replace=False)).astype(np.uint16)
+
+    @classmethod
+    def generateVolumes(cls, size: int, labelValues: np.ndarray, seed: int = 0):
+        # Label volume (uint16 label values) and normalized intensity (float32) in the NumPy (K, J, I) layout.
+        # Labels are cells of a coarse grid with wavy borders inside an ellipsoidal body, every label value
+        # is used at least once when the grid has enough cells.
+        rng = np.random.default_rng(seed)
+        cellsPerAxis = max(2, int(np.ceil(labelValues.shape[0] ** (1.0 / 3.0))))
+        cellLabels = np.resize(rng.permutation(labelValues), cellsPerAxis ** 3).reshape((cellsPerAxis,) * 3)
+        labelIntensity = rng.uniform(0.2, 1.0, size=int(labelValues.max()) + 1).astype(np.float32)
+
+        labelVolume = np.empty((size, size, size), dtype=np.uint16)
+        intensityVolume = np.empty((size, size, size), dtype=np.float32)
+        axis = (np.arange(size, dtype=np.float32) + 0.5) / size
+        y, x = np.meshgrid(axis, axis, indexing="ij")
+        cellSize = 1.0 / cellsPerAxis
+        wave = 0.25 * cellSize * np.sin(6.0 * np.pi * y)
+        for k in range(size):
+            z = axis[k]
+            inBody = (x - 0.5) ** 2 + (y - 0.5) ** 2 + (z - 0.5) ** 2 < cls.BODY_RADIUS ** 2
+            cx = np.clip(((x + wave) / cellSize).astype(np.int64), 0, cellsPerAxis - 1)
+            cy = np.clip(((y + 0.25 * cellSize * np.sin(6.0 * np.pi * z)) / cellSize).astype(np.int64), 0, cellsPerAxis - 1)
+            cz = min(int(z / cellSize), cellsPerAxis - 1)
+            labels = np.where(inBody, cellLabels[cz, cy, cx], 0).astype(np.uint16)
+            labelVolume[k] = labels
+            noise = rng.standard_normal(labels.shape, dtype=np.float32) * np.float32(0.05)
+            intensityVolume[k] = np.clip(labelIntensity[labels] * inBody + noise, 0.0, 1.0)
+        return labelVolume, intensityVolume
+
+    @staticmethod
+    def labelLookup(labelValues: np.ndarray) -> np.ndarray:
+        # Same dense labels as Context.buildLabelLookup, in the order of the label values
+        lookup = np.zeros(int(labelValues.max()) + 1, dtype=np.uint16)
+        lookup[labelValues] = np.arange(1, labelValues.shape[0] + 1, dtype=np.uint16)
+        return lookup
+
+    @classmethod
+    def generateSpheres(cls, size: int, sphereCount: int, labelCount: int, rng: np.random.Generator):
+        # Spheres (x, y, z, radius) inside the body, in IJK as the benchmark uses an identity IJK to RAS,
+        # and mask rows carving a random half of the labels for every sphere
+        center = np.full(3, size / 2.0)
+        positions = center + rng.uniform(-0.25, 0.25, size=(sphereCount, 3)) * size
+        spheres = np.column_stack((positions, np.full(sphereCount, cls.SPHERE_RADIUS * size))).astype(np.float32)
+        rows = (rng.random((sphereCount, labelCount)) < 0.5).astype(np.uint8)
+        rows[:, 0] = 1
+        return spheres, rows
+
+    @classmethod
+    def dragSphere(cls, spheres: np.ndarray, tick: int, size: int) -> np.ndarray:
+        # The last sphere moves on a small circle, like a control point being dragged
+        spheres = spheres.copy()
+        angle = tick * cls.DRAG_STEP / cls.SPHERE_RADIUS
+        radius = cls.SPHERE_RADIUS * size
+        spheres[-1, 0] += np.float32(radius * np.cos(angle))
+        spheres[-1, 1] += np.float32(radius * np.sin(angle))
+        return spheres
+
+    @staticmethod
+    def peakRssBytes() -> Optional[int]:
+        try:
+            import resource
+        except ImportError:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return int(peak) if sys.platform == "darwin" else int(peak) * 1024
+
+    @staticmethod
+    def latencyStats(seconds: List[float]) -> dict:
+        milliseconds = np.array(seconds, dtype=np.float64) * 1000.0
+        return {
+            "tickMeanMs": float(milliseconds.mean()),
+            "tickP50Ms": float(np.percentile(milliseconds, 50)),
+            "tickP95Ms": float(np.percentile(milliseconds, 95)),
+            "tickMaxMs": float(milliseconds.max()),
+        }
+
+    @classmethod
+    def textureBytes(cls, textures: List[Texture]) -> int:
+        return sum(int(np.prod(texture.dims)) * cls.TEXEL_BYTES[texture.internalformat] for texture in textures)
+
+    @staticmethod
+    def createOffscreenContext(software: bool = False) -> vtk.vtkRenderWindow:
+        # The returned window owns the context and must be kept alive while benchmarking. software selects
+        # Mesa llvmpipe, it must be requested before the first OpenGL context of the process is created.
+        if software:
+            os.environ["LIBGL_ALWAYS_SOFTWARE"] = "1"
+            os.environ["GALLIUM_DRIVER"] = "llvmpipe"
+        renderWindow = vtk.vtkRenderWindow()
+        renderWindow.SetOffScreenRendering(1)
+        renderWindow.SetSize(1, 1)
+        renderWindow.Initialize()
+        renderWindow.MakeCurrent()
+        return renderWindow
+
+    @classmethod
+    def run(cls, cases: List[dict], engine: str = "gl", ticks: int = DEFAULT_TICKS, outputFormat: str = Context.DEFAULT_OUTPUT_FORMAT,
+            intensityFormat: str = Context.DEFAULT_INTENSITY_FORMAT, seed: int = 0, verify: bool = False) -> dict:
+        # The gl engine needs a current OpenGL 4.3 context, see createOffscreenContext. verify compares the
+        # output of the last gl tick with CpuCarver, see verifyOutput.
+        if engine not in cls.ENGINES:
+            raise ValueError(f"Unsupported engine {engine}")
+        results = {
+            "version": cls.RESULTS_VERSION,
+            "commit": cls.gitCommit(),
+            "time": time.time(),
+            "platform": platformInfo.platform(),
+            "python": platformInfo.python_version(),
+            "engine": engine,
+            "renderer": glGetString(GL_RENDERER).decode() if engine == "gl" else None,
+            "cases": [],
+        }
+        profilerWasEnabled = Profiler.enabled
+        Profiler.enable()
+        try:
+            for case in cases:
+                Profiler.reset()
+                if engine == "gl":
+                    result = cls.runGpuCase(case, ticks, outputFormat, intensityFormat, seed, verify)
+                else:
+                    result = cls.runCpuCase(case, ticks, seed)
+                result.update(case, name=cls.caseName(engine, case), ticks=ticks, peakRssBytes=cls.peakRssBytes(), counters=dict(Profiler.counters))
+                logging.info(f"{result['name']}: startup ({cls.STARTUP_LABELS[engine]}) {result['startupSeconds']:.2f} s, tick {result['tickMeanMs']:.2f} ms (p95 {result['tickP95Ms']:.2f} ms)")
+                results["cases"].append(result)
+        finally:
+            Profiler.reset()
+            Profiler.enable(profilerWasEnabled)
+        return results
+
+    @classmethod
+    def runGpuCase(cls, case: dict, ticks: int, outputFormat: str, intensityFormat: str, seed: int, verify: bool = False) -> dict:
+        rng = np.random.default_rng(seed)
+        size = case["size"]
+        labelValues = cls.labelValues(case["labelCount"], case["sparseLabels"], rng)
+        labelVolume, intensityVolume = cls.generateVolumes(size, labelValues, seed)
+        spheres, rows = cls.generateSpheres(size, case["sphereCount"], labelValues.shape[0] + 1, rng)
+        colorMap = rng.integers(0, 256, size=(labelValues.shape[0] + 1, 1, 4), dtype=np.uint8)
+
+        # Startup, texture upload only: the label remapping, uploads and label dilation of Context and
+        # AnatomyCarveLogic.startRender, from arrays instead of the MRML nodes
+        glFinish()
+        startTime = time.perf_counter()
+        labelType = np.uint8 if labelValues.shape[0] + 1 <= 256 else np.uint16
+        labels = Context.remapLabels(labelVolume, cls.labelLookup(labelValues), labelType)
+        del labelVolume
+        brickOrigins = Context.buildBrickOrigins(labels, Context.BRICK_SIZE)
+        labelInternalFormat, labelGlType, labelImageFormat = Context.LABEL_FORMATS[labelType]
+        labelTex3d = Texture.fromArray(labels.reshape(labels.shape[::-1]), labelInternalFormat, GL_RED_INTEGER, labelGlType, True)
+        del labels
+        labelDilatedTex3d = Texture()
+        labelDilatedTex3d.allocate(labelTex3d.dims, labelInternalFormat, GL_RED_INTEGER, labelGlType)
+        intensityTex3d = cls.createIntensityTexture(intensityVolume, intensityFormat)
+        del intensityVolume
+        outputType, outputInternalFormat, outputImageFormat = Context.OUTPUT_FORMATS[outputFormat]
+        outputTex3d = Texture()
+        outputTex3d.allocate(labelTex3d.dims, outputInternalFormat, GL_RGBA, GL_FLOAT)
+        colorMapTex2d = Texture.fromArray(colorMap, GL_RGBA8, GL_RGBA, GL_UNSIGNED_BYTE, False)
+        maskBuffer = StorageBuffer(np.uint32, rows.shape[1] * -(-rows.shape[0] // Mask.SPHERES_PER_WORD))
+        maskBuffer.upload(Mask.packRows(rows, -(-rows.shape[0] // Mask.SPHERES_PER_WORD)))
+        sphereBuffer = StorageBuffer(np.float32, spheres.size)
+
+        dilateShader = ComputeShader("DilateLabels.comp", {"LABEL_FORMAT": labelImageFormat})
+        carveShader = ComputeShader("CarveVoxelsAA.comp", {
+            "OUTPUT_FORMAT": outputImageFormat,
+            "INTENSITY_FORMAT": Context.INTENSITY_FORMATS[intensityFormat][2],
+            "LABEL_FORMAT": labelImageFormat,
+            "BRICK_SIZE": Context.BRICK_SIZE,
+        })
+        uploadSeconds = time.perf_counter() - startTime
+
+        dilateStartTime = time.perf_counter()
+        glUseProgram(dilateShader.program)
+        dilateShader.bindTexture(0, labelTex3d, GL_READ_ONLY)
+        dilateShader.bindTexture(1, labelDilatedTex3d, GL_WRITE_ONLY)
+        dilateShader.dispatch(labelDilatedTex3d.dims)
+        glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
+        glFinish()
+        dilateSeconds = time.perf_counter() - dilateStartTime
+        startupSeconds = time.perf_counter() - startTime
+
+        # The output texture is owned by the benchmark instead of VTK, the target is not bound to a node
+        target = CarveTarget(None, outputTex3d, labelDilatedTex3d, intensityTex3d, brickOrigins)
+        target.setGroupsPerBrick(int(np.prod([Context.BRICK_SIZE // size for size in carveShader.workGroupSize()])))
+        glUseProgram(carveShader.program)
+        glUniform1i(glGetUniformLocation(carveShader.program, "labelCount"), rows.shape[1])
+        glUniformMatrix4fv(glGetUniformLocation(carveShader.program, "modelMatrix"), 1, GL_FALSE, np.eye(4, dtype=np.float32))
+        carveShader.bindTexture(4, colorMapTex2d, GL_READ_ONLY)
+        carveShader.bindBuffer(0, sphereBuffer)
+        carveShader.bindBuffer(1, maskBuffer)
+
+        def carveTick(tickSpheres: np.ndarray) -> float:
+            # Same dispatches as AnatomyCarveLogic.carveActiveTarget with synchronous carving
+            tickStartTime = time.perf_counter()
+            regions = target.carveTracker.update(tickSpheres, np.eye(4), set(), 0)
+            sphereBuffer.upload(tickSpheres)
+            glUseProgram(carveShader.program)
+            glUniform1i(glGetUniformLocation(carveShader.program, "sphereCount"), tickSpheres.shape[0])
+            target.carve(carveShader, regions)
+            glFinish()
+            return time.perf_counter() - tickStartTime
+
+        # The first carve clears the empty space, the full carves after it only visit the occupied bricks
+        carveTick(spheres)
+        target.recarveOccupiedBricks()
+        fullCarveSeconds = carveTick(spheres)
+        tickSpheres = [cls.dragSphere(spheres, tick, size) for tick in range(cls.WARMUP_TICKS + ticks)]
+        tickSeconds = [carveTick(sphereDetails) for sphereDetails in tickSpheres][cls.WARMUP_TICKS:]
+
+        textures = [labelTex3d, labelDilatedTex3d, intensityTex3d, outputTex3d, colorMapTex2d]
+        result = {
+            "startupSeconds": startupSeconds,
+            "uploadAndCompileSeconds": uploadSeconds,
+            "dilateSeconds": dilateSeconds,
+            "fullCarveMs": fullCarveSeconds * 1000.0,
+            "occupiedBricks": int(brickOrigins.shape[0]),
+            "textureBytes": cls.textureBytes(textures),
+        }
+        result.update(cls.latencyStats(tickSeconds))
+        if verify:
+            result.update(cls.verifyOutput(outputTex3d, case, labelValues, colorMap, rows, tickSpheres[-1], outputFormat, intensityFormat, seed))
+
+        target.release()
+        for resource in textures + [maskBuffer, sphereBuffer, dilateShader, carveShader]:
+            resource.release()
+        return result
+
+    @classmethod
+    def verifyOutput(cls, outputTex3d: Texture, case: dict, labelValues: np.ndarray, colorMap: np.ndarray, rows: np.ndarray,
+                     spheres: np.ndarray, outputFormat: str, intensityFormat: str, seed: int) -> dict:
+        # Carves the inputs of the case again with CpuCarver, from the intensities as stored by the texture, and
+        # compares with the GPU output read back as floats. The float formats must match exactly. The GPU
+        # conversions of the normalized formats are not exactly rounded, they may differ by a float rounding
+        # for the intensity and by one step for the output.
+        labelVolume, intensityVolume = cls.generateVolumes(case["size"], labelValues, seed)
+        intensityType = Texture.MAP_GL_TYPE_TO_NUMPY[Context.INTENSITY_FORMATS[intensityFormat][1]]
+        tolerance = 0.0
+        if np.issubdtype(intensityType, np.integer):
+            maxValue = np.float32(np.iinfo(intensityType).max)
+            intensityVolume = np.rint(intensityVolume * maxValue) / maxValue
+            tolerance = float(4 * np.finfo(np.float32).eps)
+        labels = Context.remapLabels(labelVolume, cls.labelLookup(labelValues), np.uint16)
+        expected = CpuCarver(labels, colorMap, intensityVolume).carve(rows, spheres, np.eye(4))
+
+        outputType = Context.OUTPUT_FORMATS[outputFormat][0]
+        if np.issubdtype(outputType, np.integer):
+            maxValue = np.float32(np.iinfo(outputType).max)
+            expected = np.rint(expected * maxValue) / maxValue
+            tolerance = 1.0 / maxValue
+        maxError = float(np.abs(outputTex3d.readData3d() - expected).max())
+        return {"maxAbsError": maxError, "matchesCpu": maxError <= tolerance}
+
+    @classmethod
+    def verify(cls, outputFormat: str = Context.DEFAULT_OUTPUT_FORMAT, intensityFormat: str = Context.DEFAULT_INTENSITY_FORMAT, seed: int = 0) -> dict:
+        # Carves VERIFY_CASE on the GPU and with CpuCarver, raises AssertionError when the outputs differ.
+        # Needs a current OpenGL 4.3 context like run().
+        result = cls.runGpuCase(cls.VERIFY_CASE, 1, outputFormat, intensityFormat, seed, verify=True)
+        assert result["matchesCpu"], f"GPU carve differs from CpuCarver by {result['maxAbsError']:.6g} ({outputFormat}, {intensityFormat})"
+        return result
+
+    @staticmethod
+    def createIntensityTexture(intensityVolume: np.ndarray, intensityFormat: str) -> Texture:
+        # Same storage as Texture.fromVolumeNode, the volume is already normalized
+        internalformat, glType, _ = Context.INTENSITY_FORMATS[intensityFormat]
+        dataType = Texture.MAP_GL_TYPE_TO_NUMPY[glType]
+        texture = Texture()
+        texture.allocate(intensityVolume.shape[::-1], internalformat, GL_RED, glType)
+        for z0 in range(0, intensityVolume.shape[0], Texture.UPLOAD_SLAB_DEPTH):
+            slab = intensityVolume[z0:z0 + Texture.UPLOAD_SLAB_DEPTH]
+            if np.issubdtype(dataType, np.integer):
+                slab = np.rint(slab * np.float32(np.iinfo(dataType).max)).astype(dataType)
+            texture.uploadSlab(slab, z0)
+        return texture
+
+    @classmethod
+    def runCpuCase(cls, case: dict, ticks: int, seed: int) -> dict:
+        rng = np.random.default_rng(seed)
+        size = case["size"]
+        labelValues = cls.labelValues(case["labelCount"], case["sparseLabels"], rng)
+        labelVolume, intensityVolume = cls.generateVolumes(size, labelValues, seed)
+        spheres, rows = cls.generateSpheres(size, case["sphereCount"], labelValues.shape[0] + 1, rng)
+        colorMap = rng.integers(0, 256, size=(labelValues.shape[0] + 1, 1, 4), dtype=np.uint8)
+
+        startTime = time.perf_counter()
+        labels = Context.remapLabels(labelVolume, cls.labelLookup(labelValues), np.uint16)
+        del labelVolume
+        carver = CpuCarver(labels, colorMap, intensityVolume)
+        dilateStartTime = time.perf_counter()
+        carver.dilateLabels()
+        dilateSeconds = time.perf_counter() - dilateStartTime
+        startupSeconds = time.perf_counter() - startTime
+
+        # CpuCarver has no regions, every tick carves the whole volume
+        out = np.empty(labels.shape + (4,), dtype=np.float32)
+        eye = np.eye(4)
+        fullCarveStartTime = time.perf_counter()
+        carver.carve(rows, spheres, eye, out)
+        fullCarveSeconds = time.perf_counter() - fullCarveStartTime
+        tickSeconds = []
+        for tick in range(ticks):
+            tickStartTime = time.perf_counter()
+            carver.carve(rows, cls.dragSphere(spheres, tick, size), eye, out)
+            tickSeconds.append(time.perf_counter() - tickStartTime)
+
+        result = {
+            "startupSeconds": startupSeconds,
+            "dilateSeconds": dilateSeconds,
+            "fullCarveMs": fullCarveSeconds * 1000.0,
+            "arrayBytes": int(labels.nbytes + carver.labelVolumeDilated.nbytes + carver.intensityVolume.nbytes + out.nbytes),
+        }
+        result.update(cls.latencyStats(tickSeconds))
+        return result
+
+    @staticmethod
+    def gitCommit() -> Optional[str]:
+        try:
+            return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @staticmethod
+    def save(results: dict, path: str):
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    @staticmethod
+    def load(path: str) -> dict:
+        with open(path, mode="r", encoding="utf-8") as f:
+            return json.load(f)
+
+    @classmethod
+    def compare(cls, baseline: dict, current: dict, tolerance: float = DEFAULT_TOLERANCE) -> List[dict]:
+        # One entry per metric of the cases found in both results, regressed when the current value is
+        # more than tolerance (relative) above the baseline
+        baselineCases = {case["name"]: case for case in baseline["cases"]}
+        comparison = []
+        for case in current["cases"]:
+            baselineCase = baselineCases.get(case["name"])
+            if baselineCase is None:
+                continue
+            for metric in cls.COMPARED_METRICS:
+                before = baselineCase.get(metric)
+                after = case.get(metric)
+                if before is None or after is None:
+                    continue
+                ratio = after / before if before > 0 else float("inf") if after > 0 else 1.0
+                comparison.append({
+                    "name": case["name"],
+                    "metric": metric,
+                    "baseline": before,
+                    "current": after,
+                    "ratio": ratio,
+                    "regressed": ratio > 1.0 + tolerance,
+                })
+        return comparison
+
+    @classmethod
+    def main(cls, argv: Optional[List[str]] = None) -> int:
+        parser = argparse.ArgumentParser(description="Carving benchmark on synthetic volumes")
+        parser.add_argument("--engine", choices=cls.ENGINES, default="gl")
+        parser.add_argument("--sizes", type=int, nargs="+", default=cls.DEFAULT_SIZES)
+        parser.add_argument("--labels", type=int, nargs="+", default=cls.DEFAULT_LABEL_COUNTS)
+        parser.add_argument("--label-values", choices=("dense", "sparse", "both"), default="both")
+        parser.add_argument("--spheres", type=int, nargs="+", default=cls.DEFAULT_SPHERE_COUNTS)
+        parser.add_argument("--ticks", type=int, default=cls.DEFAULT_TICKS)
+        parser.add_argument("--output-format", choices=Context.OUTPUT_FORMATS.keys(), default=Context.DEFAULT_OUTPUT_FORMAT)
+        parser.add_argument("--intensity-format", choices=Context.INTENSITY_FORMATS.keys(), default=Context.DEFAULT_INTENSITY_FORMAT)
+        parser.add_argument("--software", action="store_true", help="render with Mesa llvmpipe")
+        parser.add_argument("--output", help="JSON file of the results")
+        parser.add_argument("--compare", help="JSON file of baseline results, regressions make the exit code 1")
+        parser.add_argument("--tolerance", type=float, default=cls.DEFAULT_TOLERANCE)
+        parser.add_argument("--verify", action="store_true", help="compare the gl output of every case with CpuCarver, mismatches make the exit code 1")
+        args = parser.parse_args(argv)
+
+        sparseLabels = {"dense": (False,), "sparse": (True,), "both": (False, True)}[args.label_values]
+        cases = cls.buildCases(args.sizes, args.labels, sparseLabels, args.spheres)
+        renderWindow = cls.createOffscreenContext(args.software) if args.engine == "gl" else None
+        results = cls.run(cases, args.engine, args.ticks, args.output_format, args.intensity_format, verify=args.verify)
+        del renderWindow
+
+        for case in results["cases"]:
+            print(f"{case['name']}: startup ({cls.STARTUP_LABELS[args.engine]}) {case['startupSeconds']:.3f} s, full carve {case['fullCarveMs']:.2f} ms, "
+                  f"tick mean {case['tickMeanMs']:.2f} ms, p95 {case['tickP95Ms']:.2f} ms")
+        if args.output:
+            cls.save(results, args.output)
+
+        mismatches = [case for case in results["cases"] if case.get("matchesCpu") is False]
+        for case in mismatches:
+            print(f"MISMATCH {case['name']}: differs from CpuCarver by {case['maxAbsError']:.6g}")
+        if mismatches:
+            return 1
+        if not args.compare:
+            return 0
+        comparison = cls.compare(cls.load(args.compare), results, args.tolerance)
+        regressions = [entry for entry in comparison if entry["regressed"]]
+        for entry in regressions:
+            print(f"REGRESSION {entry['name']} {entry['metric']}: {entry['baseline']:.4g} -> {entry['current']:.4g} ({entry['ratio']:.2f}x)")
+        print(f"{len(regressions)} regressions in {len(comparison)} compared metrics")
+        return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(Benchmark.main())
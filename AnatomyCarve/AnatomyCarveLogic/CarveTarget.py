@@ -0,0 +1,190 @@
+import slicer
+import numpy as np
+
+from OpenGL.GL import *
+
+import vtk
+
+from AnatomyCarveLogic.Texture import *
+from AnatomyCarveLogic.StorageBuffer import *
+from AnatomyCarveLogic.ComputeShader import *
+from AnatomyCarveLogic.CarveTracker import *
+
+from slicer import vtkMRMLVectorVolumeNode
+
+class CarveTarget:
+    # Output volume carved by CarveVoxelsAA.comp with the label and intensity textures sampled at its voxels:
+    # the full resolution output, or the low resolution proxy shown while spheres are dragged
+    # Type of the back texture for the internal formats of Context.OUTPUT_FORMATS
+    OUTPUT_TYPES = {
+        GL_RGBA32F: GL_FLOAT,
+        GL_RGBA16: GL_UNSIGNED_SHORT,
+        GL_RGBA8: GL_UNSIGNED_BYTE,
+    }
+
+    def __init__(self, outputVolume: vtkMRMLVectorVolumeNode, outputVolumeTex3d: Texture, labelVolumeDilatedTex3d: Texture, intensityVolumeTex3d: Texture, brickOrigins: np.ndarray) -> None:
+        self.outputVolume = outputVolume
+        self.outputVolumeTex3d = outputVolumeTex3d
+        self.labelVolumeDilatedTex3d = labelVolumeDilatedTex3d
+        self.intensityVolumeTex3d = intensityVolumeTex3d
+        self.brickOrigins = brickOrigins
+        self.brickBuffer = StorageBuffer(np.int32, max(1, brickOrigins.size))
+        self.brickBuffer.upload(brickOrigins)
+        self.brickGroupCount = 0
+        self.brickDispatchBuffer = StorageBuffer(np.uint32, 3)
+        self.carveTracker = CarveTracker(outputVolumeTex3d.dims)
+        # Mask rows changed since this target was last carved, the mask hands them out only once
+        self.dirtyRows = set()
+        # The output texture starts with the uncarved CPU data, the empty bricks are cleared by one full dispatch
+        self.emptySpaceCleared = False
+        # Asynchronous carving writes a back texture, (fence, [region]) are copied to the output once their
+        # fence signaled
+        self.backTexture = None
+        self.pendingCopies = []
+        # A partitioned output texture is forced to a single block once, carving stops if it stays partitioned
+        self.singleBlockForced = False
+
+    def setGroupsPerBrick(self, groupsPerBrick: int):
+        # Work groups of the carve shader covering the occupied bricks, dispatched with glDispatchComputeIndirect
+        self.brickGroupCount = self.brickOrigins.shape[0] * groupsPerBrick
+        self.brickDispatchBuffer.upload(ComputeShader.indirectCommand(self.brickGroupCount))
+
+    def invalidate(self):
+        self.carveTracker.invalidate()
+        self.emptySpaceCleared = False
+        self.discardCopies()
+
+    def recarveOccupiedBricks(self):
+        # Carves the whole volume again on the next carve, for changes that leave the empty bricks cleared (color
+        # table). Once the empty space is cleared, the full carve only visits the occupied bricks.
+        self.carveTracker.invalidate()
+        self.discardCopies()
+
+    def addDirtyRows(self, rows: set):
+        self.dirtyRows |= rows
+
+    def popDirtyRows(self) -> set:
+        dirtyRows = self.dirtyRows
+        self.dirtyRows = set()
+        return dirtyRows
+
+    def getIJKToRASMatrix(self) -> vtk.vtkMatrix4x4:
+        modelMatrix = vtk.vtkMatrix4x4()
+        self.outputVolume.GetIJKToRASMatrix(modelMatrix)
+        return modelMatrix
+
+    def isOutputTextureValid(self) -> bool:
+        return self.outputVolumeTex3d.textureId > 0 and glIsTexture(self.outputVolumeTex3d.textureId) == GL_TRUE
+
+    def updateOutputVolumeTextureId(self, viewIndex: int) -> bool:
+        # Returns True when VTK (re)created the output texture, which then only holds the uncarved CPU data
+        if glIsTexture(self.outputVolumeTex3d.textureId) == GL_TRUE:
+            return False
+
+        helperLogic = slicer.modules.volumetextureidhelper.logic()
+        self.outputVolumeTex3d.textureId = helperLogic.GetTextureIdForVolume(self.outputVolume, viewIndex)
+        # A partitioned texture is refilled block by block from the CPU data during every render, the carve
+        # would be overwritten. Helpers built before IsTexturePartitionedForVolume cannot tell.
+        if self.isOutputTextureValid() and hasattr(helperLogic, "IsTexturePartitionedForVolume") and helperLogic.IsTexturePartitionedForVolume(self.outputVolume, viewIndex) == 1:
+            self.outputVolumeTex3d.textureId = -1
+            # Context checked that the volume fits in one texture, VTK uploads it again as a single block
+            if self.singleBlockForced or not hasattr(helperLogic, "SetSingleBlockForVolume") or helperLogic.SetSingleBlockForVolume(self.outputVolume, viewIndex) != 1:
+                raise RuntimeError(f"VTK partitioned the texture of {self.outputVolume.GetName()} into blocks, partitioned volumes cannot be carved")
+            self.singleBlockForced = True
+            self.outputVolume.GetImageData().Modified()
+            slicer.app.layoutManager().threeDWidget(viewIndex).threeDView().scheduleRender()
+        elif self.isOutputTextureValid():
+            # The carve shader and the back texture copies need the internal format of the output format
+            glBindTexture(GL_TEXTURE_3D, self.outputVolumeTex3d.textureId)
+            internalformat = int(glGetTexLevelParameteriv(GL_TEXTURE_3D, 0, GL_TEXTURE_INTERNAL_FORMAT))
+            glBindTexture(GL_TEXTURE_3D, 0)
+            if internalformat != self.outputVolumeTex3d.internalformat:
+                self.outputVolumeTex3d.textureId = -1
+                raise RuntimeError(f"VTK stored the texture of {self.outputVolume.GetName()} with internal format {internalformat:#x} instead of {self.outputVolumeTex3d.internalformat:#x}, it cannot be carved")
+        return True
+
+    def getBackTexture(self) -> Texture:
+        if self.backTexture is None:
+            self.backTexture = Texture()
+            internalformat = self.outputVolumeTex3d.internalformat
+            self.backTexture.allocate(self.outputVolumeTex3d.dims, internalformat, GL_RGBA, self.OUTPUT_TYPES[internalformat])
+        return self.backTexture
+
+    def submitCopies(self, regions: list):
+        fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.pendingCopies.append((fence, regions))
+
+    def resolveCopies(self) -> bool:
+        # Copies the carves whose fence signaled to the output, without waiting. Returns True when some are left.
+        while self.pendingCopies:
+            fence, regions = self.pendingCopies[0]
+            if glClientWaitSync(fence, 0, 0) not in (GL_ALREADY_SIGNALED, GL_CONDITION_SATISFIED):
+                break
+            glDeleteSync(fence)
+            self.pendingCopies.pop(0)
+            self.copyRegions(regions)
+        return bool(self.pendingCopies)
+
+    def flushCopies(self):
+        # Copies every pending carve without waiting for its fence, the GL executes the copies after the carves.
+        # Used when the target stops being carved, its copies would otherwise wait for the next time it is.
+        if not self.isOutputTextureValid():
+            self.discardCopies()
+            return
+        for fence, regions in self.pendingCopies:
+            glDeleteSync(fence)
+            self.copyRegions(regions)
+        self.pendingCopies = []
+
+    def copyRegions(self, regions: list):
+        for (x, y, z), size in regions:
+            glCopyImageSubData(self.backTexture.textureId, GL_TEXTURE_3D, 0, x, y, z, self.outputVolumeTex3d.textureId, GL_TEXTURE_3D, 0, x, y, z, *size)
+
+    def discardCopies(self):
+        for fence, _ in self.pendingCopies:
+            glDeleteSync(fence)
+        self.pendingCopies = []
+
+    def carve(self, shader: ComputeShader, regions: list, asyncCarve: bool = False):
+        # Dispatches CarveVoxelsAA.comp over the regions returned by carveTracker.update. The spheres, mask, color
+        # map and the uniforms shared by the targets are bound by the caller.
+        glUseProgram(shader.program)
+        shader.bindTexture(0, self.getBackTexture() if asyncCarve else self.outputVolumeTex3d, GL_READ_WRITE)
+        shader.bindTexture(1, self.labelVolumeDilatedTex3d, GL_READ_ONLY)
+        shader.bindTexture(2, self.intensityVolumeTex3d, GL_READ_ONLY)
+        shader.bindBuffer(2, self.brickBuffer)
+        fullRegion = self.carveTracker.fullRegion()
+        for region in regions:
+            # Once the empty space is cleared, full re-carves only visit the bricks holding labels
+            useBrickList = self.emptySpaceCleared and region == fullRegion
+            glUniform1i(glGetUniformLocation(shader.program, "useBrickList"), useBrickList)
+            if useBrickList:
+                glUniform1ui(glGetUniformLocation(shader.program, "brickGroupCount"), self.brickGroupCount)
+                shader.dispatchIndirect(self.brickDispatchBuffer)
+            else:
+                shader.dispatchRegion(*region)
+        self.emptySpaceCleared = True
+
+        if asyncCarve:
+            # The copies to the output wait for the fence, the next render still draws the previous result
+            glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT | GL_TEXTURE_UPDATE_BARRIER_BIT)
+            self.submitCopies(regions)
+        else:
+            glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
+
+    def releaseBackTexture(self):
+        self.discardCopies()
+        if self.backTexture is not None:
+            glDeleteTextures(1, [self.backTexture.textureId])
+        self.backTexture = None
+
+    def release(self):
+        # The label and intensity textures belong to Context for the output target
+        self.releaseBackTexture()
+        self.brickBuffer.release()
+        self.brickDispatchBuffer.release()
+
+    def setVisible(self, visible: bool):
+        displayNode = slicer.modules.volumerendering.logic().GetFirstVolumeRenderingDisplayNode(self.outputVolume)
+        if displayNode and bool(displayNode.GetVisibility()) != visible:
+            displayNode.SetVisibility(visible)
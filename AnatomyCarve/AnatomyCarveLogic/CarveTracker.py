@@ -0,0 +1,78 @@
+import numpy as np
+
+from typing import List, Optional, Tuple
+
+# (offset, size) of a voxel box in output texture coordinates (x = I, y = J, z = K)
+Region = Tuple[Tuple[int, int, int], Tuple[int, int, int]]
+
+class CarveTracker:
+    # Anti-aliasing samples of CarveVoxelsAA.comp reach one voxel away from the voxel center
+    SAMPLE_PADDING = 1
+
+    def __init__(self, dims: Tuple[int, int, int]) -> None:
+        self.dims = tuple(int(d) for d in dims)
+        self.invalidate()
+
+    def invalidate(self):
+        # Forget the last carved state, the next update will return the whole volume
+        self.spheres = None
+        self.modelMatrix = None
+        self.stateKey = None
+
+    def fullRegion(self) -> Region:
+        return (0, 0, 0), self.dims
+
+    def update(self, spheres: np.ndarray, modelMatrix: np.ndarray, dirtySphereIndices, maskGeneration: int) -> List[Region]:
+        spheres = np.asarray(spheres, dtype=np.float32).reshape(-1, 4)
+        modelMatrix = np.asarray(modelMatrix, dtype=np.float64)
+
+        # Cheap digest of every carving input, equal keys mean the carved output is still up to date
+        stateKey = (spheres.tobytes(), modelMatrix.tobytes(), maskGeneration)
+        if stateKey == self.stateKey:
+            return []
+        self.stateKey = stateKey
+
+        if self.spheres is None or not np.array_equal(modelMatrix, self.modelMatrix):
+            regions = [self.fullRegion()]
+        else:
+            regions = self.changedRegions(spheres, np.linalg.inv(modelMatrix), dirtySphereIndices)
+
+        self.spheres = spheres.copy()
+        self.modelMatrix = modelMatrix.copy()
+        return regions
+
+    def changedRegions(self, spheres: np.ndarray, rasToIjk: np.ndarray, dirtySphereIndices) -> List[Region]:
+        regions = []
+        previousCount = self.spheres.shape[0]
+        for i in range(max(previousCount, spheres.shape[0])):
+            old = self.spheres[i] if i < previousCount else None
+            new = spheres[i] if i < spheres.shape[0] else None
+            moved = old is None or new is None or not np.array_equal(old, new)
+
+            if not moved and i not in dirtySphereIndices:
+                continue
+
+            # Voxels that were carved by the old sphere must be restored, voxels in the new one carved
+            if old is not None and moved:
+                regions.append(self.sphereRegion(old, rasToIjk))
+            if new is not None:
+                regions.append(self.sphereRegion(new, rasToIjk))
+
+        return [region for region in regions if region is not None]
+
+    def sphereRegion(self, sphere: np.ndarray, rasToIjk: np.ndarray) -> Optional[Region]:
+        center = rasToIjk @ np.array([sphere[0], sphere[1], sphere[2], 1.0])
+        center = center[:3] / center[3]
+
+        # The image of a sphere of radius r under the linear part A spans r * |A_row| along each axis
+        extent = abs(float(sphere[3])) * np.linalg.norm(rasToIjk[:3, :3], axis=1)
+
+        low = np.floor(center - extent).astype(np.int64) - self.SAMPLE_PADDING
+        high = np.ceil(center + extent).astype(np.int64) + self.SAMPLE_PADDING
+        low = np.maximum(low, 0)
+        high = np.minimum(high, np.array(self.dims) - 1)
+
+        if np.any(low > high):
+            return None
+
+        return tuple(int(v) for v in low), tuple(int(v) for v in (high - low + 1))
@@ -8,6 +8,9 @@ import vtk
 import numpy as np
 
 from AnatomyCarveLogic.Texture import *
+from AnatomyCarveLogic.StorageBuffer import *
+from AnatomyCarveLogic.GpuTimer import *
+from AnatomyCarveLogic.Profiler import *
 
 import slicer
 from slicer.i18n import tr as _
@@ -25,8 +28,10 @@ from slicer import vtkMRMLScalarVolumeNode
 
 class ComputeShader:
     SHADER_PATH = os.path.join("Resources","Shaders")
+    # Minimum GL_MAX_COMPUTE_WORK_GROUP_COUNT guaranteed by OpenGL 4.3
+    MAX_WORK_GROUP_COUNT = 65535
     
-    def __init__(self, computeShaderPath: str):
+    def __init__(self, computeShaderPath: str, defines: Optional[dict] = None):
         moduleFolder = os.path.dirname(slicer.util.modulePath("AnatomyCarve"))
         shaderPath = os.path.join(moduleFolder, self.SHADER_PATH, computeShaderPath)
         shaderCode = ""
@@ -35,7 +40,19 @@ class ComputeShader:
             for line in f:
                 shaderCode += line
                 
-        self.program = self.createComputeShader(shaderCode)
+        self.program = self.createComputeShader(self.addDefines(shaderCode, defines))
+        # Pass name of the GPU timings, dispatches are only timed when a GpuTimer is set
+        self.name = os.path.splitext(computeShaderPath)[0]
+        self.timer: Optional[GpuTimer] = None
+
+    @staticmethod
+    def addDefines(shaderCode: str, defines: Optional[dict]) -> str:
+        # The defines go right after the #version directive, which must stay the first line
+        if not defines:
+            return shaderCode
+        versionLine, _, body = shaderCode.partition("\n")
+        defineLines = "".join(f"#define {name} {value}\n" for name, value in defines.items())
+        return versionLine + "\n" + defineLines + body
                 
     def createComputeShader(self, src):
         shader = glCreateShader(GL_COMPUTE_SHADER)
@@ -52,13 +69,25 @@ class ComputeShader:
             raise RuntimeError("Shader program failed to link.")
         return prog
     
+    def release(self):
+        if self.program:
+            glDeleteProgram(self.program)
+        self.program = 0
+
     def bindTexture(self, unit: int, texture: Texture, access: int):
         glBindImageTexture(unit, texture.textureId, 0, GL_TRUE, 0, access, texture.internalformat)
+
+    def bindBuffer(self, binding: int, buffer: StorageBuffer):
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, binding, buffer.bufferId)
     
-    def dispatch(self, threadSizeXYZ: tuple[int,int,int]):
-        # Assume `program` is your linked compute shader program (GLuint)
+    def workGroupSize(self) -> tuple[int,int,int]:
         work_group_size = (GLint * 3)()
         glGetProgramiv(self.program, GL_COMPUTE_WORK_GROUP_SIZE, work_group_size)
+        return tuple(work_group_size)
+
+    def dispatch(self, threadSizeXYZ: tuple[int,int,int]):
+        # Assume `program` is your linked compute shader program (GLuint)
+        work_group_size = self.workGroupSize()
 
         # print("Local work group size:")
         # print(f"X: {work_group_size[0]}")
@@ -73,4 +102,31 @@ class ComputeShader:
         threadGroupsY += 0 if threadSizeXYZ[1] % work_group_size[1] == 0 else 1
         threadGroupsZ += 0 if threadSizeXYZ[2] % work_group_size[2] == 0 else 1
 
-        glDispatchCompute(threadGroupsX, threadGroupsY, threadGroupsZ)
\ No newline at end of file
+        timed = self.timer is not None and self.timer.begin(self.name)
+        glDispatchCompute(threadGroupsX, threadGroupsY, threadGroupsZ)
+        if timed:
+            self.timer.end()
+        Profiler.count("dispatches")
+
+    def dispatchIndirect(self, commandBuffer: StorageBuffer, offset: int = 0):
+        # commandBuffer holds (x, y, z) work group counts as uint, offset is in items
+        glBindBuffer(GL_DISPATCH_INDIRECT_BUFFER, commandBuffer.bufferId)
+        timed = self.timer is not None and self.timer.begin(self.name)
+        glDispatchComputeIndirect(offset * commandBuffer.dtype.itemsize)
+        if timed:
+            self.timer.end()
+        glBindBuffer(GL_DISPATCH_INDIRECT_BUFFER, 0)
+        Profiler.count("dispatches")
+
+    @classmethod
+    def indirectCommand(cls, workGroupCount: int) -> np.ndarray:
+        # Linear work group counts above the limit are folded into rows, shaders rebuild the linear index
+        # as gl_WorkGroupID.y * gl_NumWorkGroups.x + gl_WorkGroupID.x and skip the groups past the count
+        x = min(workGroupCount, cls.MAX_WORK_GROUP_COUNT)
+        y = -(-workGroupCount // x) if x > 0 else 0
+        return np.array([x, y, 1], dtype=np.uint32)
+
+    def dispatchRegion(self, offsetXYZ: tuple[int,int,int], sizeXYZ: tuple[int,int,int]):
+        # Shaders supporting partial dispatches add `dispatchOffset` to gl_GlobalInvocationID
+        glUniform3i(glGetUniformLocation(self.program, "dispatchOffset"), *offsetXYZ)
+        self.dispatch(sizeXYZ)
\ No newline at end of file
@@ -2,15 +2,21 @@ import logging
 import os
 import slicer
 import numpy as np
+import concurrent.futures
+
+from concurrent.futures import ThreadPoolExecutor
 from AnatomyCarveLogic.Texture import *
 from AnatomyCarveLogic.Mask import *
+from AnatomyCarveLogic.CarveTarget import *
+from AnatomyCarveLogic.Profiler import *
+from AnatomyCarveLogic.VolumeCache import *
 
 from OpenGL.GL import *
 
 import vtk
 from vtk.util import numpy_support
 
-from typing import Tuple
+from typing import Callable, Optional, Tuple
 
 from slicer import vtkMRMLScalarVolumeNode, vtkMRMLSegmentationNode, vtkMRMLViewNode, vtkMRMLMarkupsFiducialNode, vtkMRMLVectorVolumeNode
 import vtkSegmentationCorePython as vtkSegmentationCore
@@ -18,99 +24,213 @@ import vtkSegmentationCorePython as vtkSegmentationCore
 
 class Context:
     COLOR_NUM_COMPONENTS = 4
+    # Edge of the bricks of the occupancy index, in voxels. Must be a multiple of the carve work group size.
+    BRICK_SIZE = 8
+
+    # Output volume formats: scalar type of the output node, texture format VTK creates for it and the
+    # matching image format of CarveVoxelsAA.comp
+    OUTPUT_FORMATS = {
+        "RGBA32F": (np.float32, GL_RGBA32F, "rgba32f"),
+        "RGBA16": (np.uint16, GL_RGBA16, "rgba16"),
+        "RGBA8": (np.uint8, GL_RGBA8, "rgba8"),
+    }
+    DEFAULT_OUTPUT_FORMAT = "RGBA32F"
+    # Intensity texture formats: internal format, upload type and image format of CarveVoxelsAA.comp
+    INTENSITY_FORMATS = {
+        "R32F": (GL_R32F, GL_FLOAT, "r32f"),
+        "R16": (GL_R16, GL_UNSIGNED_SHORT, "r16"),
+        "R8": (GL_R8, GL_UNSIGNED_BYTE, "r8"),
+    }
+    DEFAULT_INTENSITY_FORMAT = "R32F"
+    # Label texture formats by label type: internal format, upload type and image format of the shaders
+    LABEL_FORMATS = {
+        np.uint8: (GL_R8UI, GL_UNSIGNED_BYTE, "r8ui"),
+        np.uint16: (GL_R16UI, GL_UNSIGNED_SHORT, "r16ui"),
+    }
+    # Slices of the output volume initialized at once, bounds the temporary memory of the intensity conversion
+    OUTPUT_SLAB_DEPTH = 16
+    # Threads preparing the volumes on the CPU, one per preparation step
+    PREPARATION_WORKERS = 4
+    # Interval of the progress callback while the calling thread waits for a preparation step
+    PROGRESS_INTERVAL_SECONDS = 0.05
 
     def __init__(self, intensityVolume: vtkMRMLScalarVolumeNode, 
                  segmentation: vtkMRMLSegmentationNode, 
-                 view: vtkMRMLViewNode) -> None:
+                 view: vtkMRMLViewNode,
+                 outputFormat: str = DEFAULT_OUTPUT_FORMAT,
+                 intensityFormat: str = DEFAULT_INTENSITY_FORMAT,
+                 cache: Optional[VolumeCache] = None,
+                 progress: Optional[Callable[[str, float], None]] = None) -> None:
+        if outputFormat not in self.OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format {outputFormat}")
+        if intensityFormat not in self.INTENSITY_FORMATS:
+            raise ValueError(f"Unsupported intensity format {intensityFormat}")
         self.intensityVolume = intensityVolume
         self.segmentation = segmentation
         self.view = view
-        self.labelToColorMapTex2d = self.createLabelToColorMap()        
-        self.outputVolume, self.outputVolumeTex3d = self.createVectorVolume()
-        self.labelVolumeTex3d = self.createLabelVolume()
-        self.labelVolumeDilatedTex3d = Texture.fromArray(np.zeros(self.labelVolumeTex3d.dims, dtype=np.uint16), GL_R16UI, GL_RED_INTEGER, GL_UNSIGNED_SHORT, True)
-        self.intensityVolumeTex3d = Texture.fromVolumeNode(intensityVolume, GL_R32F, GL_RED, GL_FLOAT, 1.0)
-        self.mask = Mask(segmentation, 0)
-        self.labelToColorVolumeTex3d = Texture.fromArray(np.zeros(self.outputVolumeTex3d.dims + (self.COLOR_NUM_COMPONENTS,), dtype=np.uint8), GL_RGBA8, GL_RGBA, GL_UNSIGNED_BYTE, False)
-
-    def createLabelToColorMap(self) -> Texture:
-        #segNode = self.getParameterNode().segmentation           # or your node’s exact name/ID
-        segmentation = self.segmentation.GetSegmentation()
-        displayNode = self.segmentation.GetDisplayNode()
-
-        # 2. Get the list of segment IDs
-        segmentIDs = segmentation.GetSegmentIDs()                 # vtkSegmentation::GetSegmentIDs :contentReference[oaicite:0]{index=0}
-
-        # 3. Build a mapping from label value → RGB color
-        labelColorMapping = {}
-        for segID in segmentIDs:
-            seg = segmentation.GetSegment(segID)
-            labelValue = seg.GetLabelValue()                      # vtkSegment::GetLabelValue :contentReference[oaicite:1]{index=1}
-
-            # get the actual display color (including any overrides)
-            r, g, b = displayNode.GetSegmentColor(segID)          # vtkMRMLSegmentationDisplayNode::GetSegmentColor :contentReference[oaicite:2]{index=2}
-
-            labelColorMapping[labelValue] = (r, g, b)
-
-        # 4. Compute the maximum label value
-        maxLabel = max(
-            segmentation.GetSegment(segID).GetLabelValue() # vtkSegment::GetLabelValue 
-            for segID in segmentIDs
-        )
-
-        colorMap = np.zeros((maxLabel + 1, 1, self.COLOR_NUM_COMPONENTS))
-
-        for label in labelColorMapping:
-            colorMap[label, 0, 0] = labelColorMapping[label][0]
-            colorMap[label, 0, 1] = labelColorMapping[label][1]
-            colorMap[label, 0, 2] = labelColorMapping[label][2]
+        self.makeCurrent()
+        self.checkTextureSize(intensityVolume.GetImageData().GetDimensions())
+        self.outputFormat = outputFormat
+        self.intensityFormat = intensityFormat
+        # Segment label values are remapped to dense labels 1..N, used by all the label indexed data
+        self.labelLookup = self.buildLabelLookup(segmentation)
+        self.labelCount = int(self.labelLookup.max()) + 1
+        self.labelType = np.uint8 if self.labelCount <= 256 else np.uint16
+        # The label volumes and the normalized intensity are reused from the cache when their inputs were seen
+        # before, keys are None when the inputs cannot be hashed
+        self.cache = cache
+        # Called with (message, fraction done) on the calling thread while it waits, e.g. to process UI events
+        self.progress = progress
+
+        # MRML nodes are only read on the calling thread, which also creates the nodes and uploads the textures as
+        # it owns the GL context. The thread pool only gets NumPy arrays: the intensity scalars, the labelmap
+        # layers hashed for the cache key and the exported merged labelmap. NumPy releases the GIL.
+        intensity = slicer.util.arrayFromVolume(intensityVolume)
+        labelCacheKeyParts = self.buildLabelCacheKeyParts() if cache is not None else None
+        with Profiler.phase("createLabelToColorMap"):
+            self.labelToColorMap = self.buildLabelToColorMap(segmentation, self.labelLookup)
+            self.labelToColorMapTex2d = Texture.fromArray(self.labelToColorMap, GL_RGBA8, GL_RGBA, GL_UNSIGNED_BYTE, False)
+        outputImageData, outputScalars = self.allocateOutputImageData()
+
+        with ThreadPoolExecutor(max_workers=self.PREPARATION_WORKERS) as executor:
+            outputFuture = executor.submit(self.fillOutputScalars, outputScalars, intensity)
+            labelsFuture = executor.submit(self.loadLabelVolumes, labelCacheKeyParts)
+            # Without a cache, the intensity is normalized while it is uploaded, see createIntensityVolume
+            intensityFuture = executor.submit(self.prepareIntensityVolume, intensity) if cache is not None else None
+
+            with Profiler.phase("createVectorVolume"):
+                self.outputVolume, self.outputVolumeTex3d = self.createVectorVolume(outputImageData, *self.waitForPreparation(outputFuture, "Building the output volume", 0.1))
+            with Profiler.phase("createLabelVolume"):
+                self.labelCacheKey, labelVolume, self.brickOrigins, labelVolumeDilated = self.waitForPreparation(labelsFuture, "Building the label volume", 0.3)
+                if labelVolume is None:
+                    # Not cached, the merged labelmap is exported here and remapped on the thread pool
+                    mergedLabelVolume = self.buildLabelVolume(segmentation)
+                    labelFuture = executor.submit(self.prepareLabelVolume, mergedLabelVolume, self.labelCacheKey)
+                    labelVolume, self.brickOrigins = self.waitForPreparation(labelFuture, "Building the label volume", 0.4)
+                    del mergedLabelVolume
+                self.labelVolumeTex3d = self.createLabelVolume(labelVolume)
+            self.labelVolumeDilatedTex3d = Texture()
+            self.labelVolumeDilatedTex3d.allocate(self.labelVolumeTex3d.dims, self.labelVolumeTex3d.internalformat, GL_RED_INTEGER, self.labelVolumeTex3d.type)
+            # When False, the dilated labels must be computed, see saveDilatedLabels
+            self.labelVolumeDilatedLoaded = labelVolumeDilated is not None
+            if self.labelVolumeDilatedLoaded:
+                self.labelVolumeDilatedTex3d.uploadSlabs(labelVolumeDilated)
+            with Profiler.phase("createIntensityVolume"):
+                self.intensityCacheKey, normalizedIntensity = self.waitForPreparation(intensityFuture, "Normalizing the intensity", 0.7) if intensityFuture is not None else (None, None)
+                self.intensityVolumeTex3d = self.createIntensityVolume(intensity, normalizedIntensity)
+        self.reportProgress("Volumes ready", 1.0)
+        self.mask = Mask(segmentation, 0, self.labelLookup)
+        self.outputTarget = CarveTarget(self.outputVolume, self.outputVolumeTex3d, self.labelVolumeDilatedTex3d, self.intensityVolumeTex3d, self.brickOrigins)
+
+    @staticmethod
+    def checkTextureSize(dims: Tuple[int, int, int]):
+        # Every volume is one 3D texture, a partitioned output texture is forced back to a single block which must fit
+        maxTextureSize = int(glGetIntegerv(GL_MAX_3D_TEXTURE_SIZE))
+        if max(dims) > maxTextureSize:
+            raise ValueError(f"Volume dimensions {tuple(dims)} exceed the maximum 3D texture size {maxTextureSize}, partitioned volumes are not supported")
+
+    def reportProgress(self, message: str, fraction: float):
+        if self.progress is not None:
+            self.progress(message, fraction)
+            # The callback may process events, which render other views with their own GL contexts
+            self.makeCurrent()
+
+    def makeCurrent(self):
+        # The textures are created in the GL context of the view, where VTK creates the output texture
+        slicer.app.layoutManager().threeDWidget(self.getViewIndex()).threeDView().renderWindow().MakeCurrent()
+
+    def waitForPreparation(self, future: concurrent.futures.Future, message: str, fraction: float):
+        # Result of a preparation step, the progress callback keeps being called until it is done
+        while self.progress is not None and not future.done():
+            self.reportProgress(message, fraction)
+            concurrent.futures.wait([future], timeout=self.PROGRESS_INTERVAL_SECONDS)
+        return future.result()
+
+    def updateLabelToColorMap(self) -> bool:
+        # Uploads the color table again when a segment color changed, returns True in that case
+        colorMap = self.buildLabelToColorMap(self.segmentation, self.labelLookup)
+        if np.array_equal(colorMap, self.labelToColorMap):
+            return False
+        self.labelToColorMap = colorMap
+        self.labelToColorMapTex2d.updateData2d(colorMap)
+        return True
+
+    def segmentLabelsChanged(self) -> bool:
+        # The label volume, the mask and the color table keep the dense labels of the segments present when the
+        # context was created. Segments added, removed or relabelled since then are only carved after a new Render.
+        return not np.array_equal(self.buildLabelLookup(self.segmentation), self.labelLookup)
+
+    @staticmethod
+    def buildLabelLookup(segmentationNode: vtkMRMLSegmentationNode) -> np.ndarray:
+        # lookup[labelValue] is the dense label of the segment with that label value, 0 for the background
+        # and for values not used by any segment
+        segmentation = segmentationNode.GetSegmentation()
+        labels = sorted({segmentation.GetSegment(segID).GetLabelValue() for segID in segmentation.GetSegmentIDs()} - {0})
+        lookup = np.zeros(max(labels, default=0) + 1, dtype=np.uint16)
+        lookup[labels] = np.arange(1, len(labels) + 1)
+        return lookup
+
+    @staticmethod
+    def buildLabelToColorMap(segmentationNode: vtkMRMLSegmentationNode, labelLookup: np.ndarray) -> np.ndarray:
+        # RGBA8 color of every dense label of labelLookup, the background is transparent. Segments without a dense
+        # label (added after labelLookup was built) are left out, the table keeps its size.
+        segmentation = segmentationNode.GetSegmentation()
+        displayNode = segmentationNode.GetDisplayNode()
+
+        colorMap = np.zeros((int(labelLookup.max()) + 1, 1, Context.COLOR_NUM_COMPONENTS))
+        for segID in segmentation.GetSegmentIDs():
+            labelValue = segmentation.GetSegment(segID).GetLabelValue()
+            label = labelLookup[labelValue] if 0 <= labelValue < labelLookup.shape[0] else 0
+            if label == 0:
+                continue
+            # Display color, including the overrides of the display node
+            colorMap[label, 0, :3] = displayNode.GetSegmentColor(segID)
             colorMap[label, 0, 3] = 1.0
 
-        colorMap[0, 0, 3] = 0.0
-
-        #print(colorMap.shape)
-        
-        # ## TODO: Remove
-        # for i in range(colorMap.shape[0]):
-        #     colorMap[i, 0, 0] = 255
-        #     colorMap[i, 0, 1] = 255
-        #     colorMap[i, 0, 2] = 0
-        #     colorMap[i, 0, 3] = 255
-        
         colorMap *= 255.0
-        
-
-        return Texture.fromArray(colorMap.astype(np.uint8), GL_RGBA8, GL_RGBA, GL_UNSIGNED_BYTE, False)
+        return colorMap.astype(np.uint8)
+
+    def allocateOutputImageData(self) -> Tuple[vtk.vtkImageData, np.ndarray]:
+        # Output scalars, allocated once and filled in place through the returned NumPy view by fillOutputScalars
+        dims = self.intensityVolume.GetImageData().GetDimensions()
+        outputType = self.OUTPUT_FORMATS[self.outputFormat][0]
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(dims)
+        imageData.AllocateScalars(numpy_support.get_vtk_array_type(np.dtype(outputType)), self.COLOR_NUM_COMPONENTS)
+        arrayRGBA = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(dims[::-1] + (self.COLOR_NUM_COMPONENTS,))
+        return imageData, arrayRGBA
+
+    def fillOutputScalars(self, arrayRGBA: np.ndarray, arrayA: np.ndarray) -> Tuple[int, int]:
+        # Uncarved volume and the alpha range of its opacity transfer function, runs on the thread pool
+        outputType = self.OUTPUT_FORMATS[self.outputFormat][0]
+        minIntensity, maxIntensity = float(arrayA.min()), float(arrayA.max())
+
+        if outputType == np.float32:
+            colorValue = 1.0
+            alphaScale = 1.0
+            alphaOffset = 0.0
+            minAlpha, maxAlpha = int(minIntensity), int(maxIntensity)
+        else:
+            # Normalized integer texture, the carve shader stores [0, 1] values which VTK reads as [0, max]
+            colorValue = np.iinfo(outputType).max
+            alphaScale = colorValue / (maxIntensity - minIntensity)
+            alphaOffset = minIntensity
+            minAlpha, maxAlpha = 0, colorValue
+
+        for z0 in range(0, arrayRGBA.shape[0], self.OUTPUT_SLAB_DEPTH):
+            slab = arrayRGBA[z0:z0 + self.OUTPUT_SLAB_DEPTH]
+            slab[..., 0] = 0
+            slab[..., 1:3] = colorValue
+            slab[..., 3] = (arrayA[z0:z0 + self.OUTPUT_SLAB_DEPTH].astype(np.float32) - np.float32(alphaOffset)) * np.float32(alphaScale)
+        return minAlpha, maxAlpha
+
+    def createVectorVolume(self, imageData: vtk.vtkImageData, minAlpha: int, maxAlpha: int) -> Tuple[vtkMRMLVectorVolumeNode, Texture]:
+        _, outputInternalFormat, _ = self.OUTPUT_FORMATS[self.outputFormat]
 
-        ## 4. Print it out
-        #print("Label → Color mapping:")
-        #for label, (r, g, b) in sorted(labelColorMapping.items()):
-        #print(f"  • Label {label:3d} → (R={r:.3f}, G={g:.3f}, B={b:.3f})")
-
-    def createVectorVolume(self) -> Tuple[vtkMRMLVectorVolumeNode, Texture]:
-        #intensityVolume = self.getParameterNode().intensityVolume
-        
-        dims = self.intensityVolume.GetImageData().GetDimensions() 
-        
-        dims = dims[::-1]
-        
-        #print(dims)
-        
-        arrayR = np.zeros(dims, dtype=np.float32)
-        arrayG = np.ones(dims, dtype=np.float32)
-        arrayB = np.ones(dims, dtype=np.float32)        
-        arrayA = slicer.util.arrayFromVolume(self.intensityVolume).astype(np.float32) #np.ones(dims, dtype=np.uint8)
-
-        arrayRGBA = np.stack((arrayR, arrayG, arrayB, arrayA), axis=-1)
-        
-        minAlpha, maxAlpha = int(arrayA.min()), int(arrayA.max())
-        #print(f"Alpha range (NumPy): min={minAlpha}, max={maxAlpha}")
-        
-        #print(arrayRGBA.shape)
-        
         # Create new volume node
         outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode", "AnatomyCarve Output")
-        slicer.util.updateVolumeFromArray(outputVolume, arrayRGBA)
+        outputVolume.SetAndObserveImageData(imageData)
+        outputVolume.CreateDefaultDisplayNodes()
 
         # Copy geometry (origin, spacing, matrix)
         outputVolume.SetOrigin(self.intensityVolume.GetOrigin())
@@ -172,18 +292,209 @@ class Context:
         #self.rgbaVolume = rgbaVolume
 
         #print(textureId)
-        return outputVolume, Texture.fromOpenGLTexture(textureId, self.intensityVolume.GetImageData().GetDimensions(), GL_RGBA32F, GL_RGB, GL_FLOAT)
-    
-    def updateOutputVolumeTextureId(self):
-        if glIsTexture(self.outputVolumeTex3d.textureId) == GL_TRUE:
-            return
-        
-        viewIndex = self.getViewIndex()
-        self.outputVolumeTex3d.textureId = slicer.modules.volumetextureidhelper.logic().GetTextureIdForVolume(self.outputVolume, viewIndex)
-        #print(self.outputVolumeTex3d.textureId)
+        return outputVolume, Texture.fromOpenGLTexture(textureId, self.intensityVolume.GetImageData().GetDimensions(), outputInternalFormat, GL_RGB, GL_FLOAT)
 
+    def outputImageFormat(self) -> str:
+        return self.OUTPUT_FORMATS[self.outputFormat][2]
 
-    def createLabelVolume(self) -> Texture:
+    def intensityImageFormat(self) -> str:
+        return self.INTENSITY_FORMATS[self.intensityFormat][2]
+    
+    def createProxyTarget(self, factor: int) -> CarveTarget:
+        # Low resolution copy of the output, every proxy voxel covers factor^3 output voxels. The label and
+        # intensity textures are only allocated, they are downsampled on the GPU from the full resolution ones.
+        dims = tuple(-(-d // factor) for d in self.outputVolumeTex3d.dims)
+        outputVolume = self.createProxyVolume(dims, factor)
+        outputVolumeTex3d = Texture.fromOpenGLTexture(-1, dims, self.outputVolumeTex3d.internalformat, GL_RGB, GL_FLOAT)
+        labelVolumeDilatedTex3d = Texture()
+        labelVolumeDilatedTex3d.allocate(dims, self.labelVolumeDilatedTex3d.internalformat, GL_RED_INTEGER, self.labelVolumeDilatedTex3d.type)
+        intensityVolumeTex3d = Texture()
+        intensityVolumeTex3d.allocate(dims, self.intensityVolumeTex3d.internalformat, GL_RED, self.intensityVolumeTex3d.type)
+        brickOrigins = self.buildProxyBrickOrigins(self.brickOrigins, factor, self.BRICK_SIZE)
+        return CarveTarget(outputVolume, outputVolumeTex3d, labelVolumeDilatedTex3d, intensityVolumeTex3d, brickOrigins)
+
+    def createProxyVolume(self, dims: Tuple[int, int, int], factor: int) -> vtkMRMLVectorVolumeNode:
+        outputType = self.OUTPUT_FORMATS[self.outputFormat][0]
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(dims)
+        imageData.AllocateScalars(numpy_support.get_vtk_array_type(np.dtype(outputType)), self.COLOR_NUM_COMPONENTS)
+        # Fully transparent until it is carved
+        imageData.GetPointData().GetScalars().Fill(0)
+
+        # Internal to the module, the proxy is neither listed in the data module nor saved with the scene
+        proxyVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVectorVolumeNode", "AnatomyCarve Proxy")
+        proxyVolume.SetHideFromEditors(True)
+        proxyVolume.SetSaveWithScene(False)
+        proxyVolume.SetAndObserveImageData(imageData)
+        proxyVolume.CreateDefaultDisplayNodes()
+
+        # Proxy voxel p is centered on the output voxels [factor * p, factor * p + factor - 1]
+        ijkToRAS = vtk.vtkMatrix4x4()
+        self.outputVolume.GetIJKToRASMatrix(ijkToRAS)
+        proxyToOutput = vtk.vtkMatrix4x4()
+        for axis in range(3):
+            proxyToOutput.SetElement(axis, axis, factor)
+            proxyToOutput.SetElement(axis, 3, (factor - 1) / 2.0)
+        proxyToRAS = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Multiply4x4(ijkToRAS, proxyToOutput, proxyToRAS)
+        proxyVolume.SetIJKToRASMatrix(proxyToRAS)
+
+        # Rendered with the transfer functions of the output, hidden until an interaction starts
+        volRenLogic = slicer.modules.volumerendering.logic()
+        displayNode = volRenLogic.CreateDefaultVolumeRenderingNodes(proxyVolume)
+        defaultPropertyNode = displayNode.GetVolumePropertyNode()
+        displayNode.SetAndObserveVolumePropertyNodeID(volRenLogic.GetFirstVolumeRenderingDisplayNode(self.outputVolume).GetVolumePropertyNodeID())
+        slicer.mrmlScene.RemoveNode(defaultPropertyNode)
+        displayNode.SetVisibility(False)
+        for index in range(proxyVolume.GetNumberOfDisplayNodes()):
+            proxyVolume.GetNthDisplayNode(index).SetHideFromEditors(True)
+            proxyVolume.GetNthDisplayNode(index).SetSaveWithScene(False)
+        return proxyVolume
+
+    def releaseProxyTarget(self, proxyTarget: CarveTarget):
+        # Unlike the output target, the proxy owns its label and intensity textures. The output texture belongs
+        # to VTK and is freed with the node, the volume property node is shared with the output and stays.
+        proxyTarget.release()
+        proxyTarget.labelVolumeDilatedTex3d.release()
+        proxyTarget.intensityVolumeTex3d.release()
+        proxyVolume = proxyTarget.outputVolume
+        displayNodes = [proxyVolume.GetNthDisplayNode(index) for index in range(proxyVolume.GetNumberOfDisplayNodes())]
+        for displayNode in displayNodes:
+            slicer.mrmlScene.RemoveNode(displayNode)
+        slicer.mrmlScene.RemoveNode(proxyVolume)
+
+    @staticmethod
+    def buildProxyBrickOrigins(brickOrigins: np.ndarray, factor: int, brickSize: int) -> np.ndarray:
+        # A proxy brick covers factor^3 output bricks, it is occupied when one of them is
+        bricks = np.unique(brickOrigins[:, :3] // (brickSize * factor), axis=0)
+        return np.column_stack((bricks * brickSize, np.zeros(bricks.shape[0], dtype=bricks.dtype))).astype(np.int32)
+
+    def loadLabelVolumes(self, keyParts: Optional[list]) -> Tuple[Optional[str], Optional[np.ndarray], Optional[np.ndarray], Optional[np.ndarray]]:
+        # Cache key, and the label volume, occupied bricks and dilated labels found in the cache, None when not
+        # cached. Runs on the thread pool, the volumes are in the NumPy (K, J, I) layout.
+        with Profiler.phase("loadLabelVolumes"):
+            key = VolumeCache.hashKey(*keyParts) if keyParts is not None else None
+            arr = self.loadCached(key, "labels")
+            brickOrigins = self.loadCached(key, "brickOrigins")
+            if arr is None or brickOrigins is None:
+                return key, None, None, None
+            return key, arr, brickOrigins, self.loadCached(key, "labelsDilated")
+
+    def prepareLabelVolume(self, mergedLabelVolume: np.ndarray, key: Optional[str]) -> Tuple[np.ndarray, np.ndarray]:
+        # Dense labels and occupied bricks of the merged labelmap exported by buildLabelVolume, runs on the thread pool
+        with Profiler.phase("prepareLabelVolume"):
+            arr = self.remapLabels(mergedLabelVolume, self.labelLookup, self.labelType)
+            brickOrigins = self.buildBrickOrigins(arr, self.BRICK_SIZE)
+            self.saveCached(key, "labels", arr)
+            self.saveCached(key, "brickOrigins", brickOrigins)
+            return arr, brickOrigins
+
+    def createLabelVolume(self, labelVolume: np.ndarray) -> Texture:
+        # Texture dimensions are (I, J, K), the memory layout is unchanged
+        arr = labelVolume.reshape(labelVolume.shape[::-1])
+        labelInternalFormat, labelType, _ = self.LABEL_FORMATS[self.labelType]
+        return Texture.fromArray(arr, labelInternalFormat, GL_RED_INTEGER, labelType, True)
+
+    def saveDilatedLabels(self):
+        # Called once the dilation shader filled labelVolumeDilatedTex3d, reads it back for the next sessions
+        if self.labelCacheKey is not None:
+            self.saveCached(self.labelCacheKey, "labelsDilated", self.labelVolumeDilatedTex3d.readData3d())
+        self.labelVolumeDilatedLoaded = True
+
+    def prepareIntensityVolume(self, data: np.ndarray) -> Tuple[str, np.ndarray]:
+        # Cache key and normalized intensity in the storage type of the intensity format, memory mapped from the
+        # cache. Only used with a cache, runs on the thread pool.
+        with Profiler.phase("prepareIntensityVolume"):
+            _, intensityType, _ = self.INTENSITY_FORMATS[self.intensityFormat]
+            key = VolumeCache.hashKey("intensity", self.intensityFormat, data)
+            intensity = self.loadCached(key, "intensity")
+            if intensity is not None:
+                return key, intensity
+            # Written to the cache slab by slab and uploaded from its memory map
+            with self.cache.writer(key, "intensity", data.shape, Texture.MAP_GL_TYPE_TO_NUMPY[intensityType]) as write:
+                for _, slab in Texture.normalizedSlabs(data, intensityType, 1.0):
+                    write(slab)
+            return key, self.loadCached(key, "intensity")
+
+    def createIntensityVolume(self, data: np.ndarray, normalizedIntensity: Optional[np.ndarray]) -> Texture:
+        # Uploads the normalized intensity of the cache. Without it, data is normalized slab by slab while it is
+        # uploaded, only one slab is held in memory.
+        intensityInternalFormat, intensityType, _ = self.INTENSITY_FORMATS[self.intensityFormat]
+        texture = Texture()
+        texture.allocate(data.shape[::-1], intensityInternalFormat, GL_RED, intensityType)
+        if normalizedIntensity is not None:
+            texture.uploadSlabs(normalizedIntensity)
+            return texture
+        for z0, slab in Texture.normalizedSlabs(data, intensityType, 1.0):
+            self.reportProgress("Normalizing the intensity", 0.7 + 0.3 * z0 / data.shape[0])
+            texture.uploadSlab(slab, z0)
+        return texture
+
+    def buildLabelCacheKeyParts(self) -> Optional[list]:
+        # What GenerateMergedLabelmapForAllSegments reads, hashed into the cache key by loadLabelVolumes: the
+        # binary labelmap layers, the segments and their label values, and the reference geometry. None when the
+        # labelmaps are not available. Reads the segmentation, so it runs on the calling thread.
+        segmentation = self.segmentation.GetSegmentation()
+        converter = vtkSegmentationCore.vtkSegmentationConverter
+        if not segmentation.ContainsRepresentation(converter.GetBinaryLabelmapRepresentationName()):
+            return None
+        parts = ["labels", np.dtype(self.labelType).str, self.BRICK_SIZE, segmentation.GetConversionParameter(converter.GetReferenceImageGeometryParameterName())]
+        for i in range(segmentation.GetNumberOfSegments()):
+            segmentID = segmentation.GetNthSegmentID(i)
+            parts.append((segmentID, segmentation.GetSegment(segmentID).GetLabelValue(), segmentation.GetLayerIndex(segmentID)))
+        for layer in range(segmentation.GetNumberOfLayers()):
+            labelmap = segmentation.GetLayerDataObject(layer)
+            imageToWorld = vtk.vtkMatrix4x4()
+            labelmap.GetImageToWorldMatrix(imageToWorld)
+            scalars = labelmap.GetPointData().GetScalars()
+            parts += [labelmap.GetExtent(), slicer.util.arrayFromVTKMatrix(imageToWorld), numpy_support.vtk_to_numpy(scalars) if scalars is not None else None]
+        return parts
+
+    def loadCached(self, key: Optional[str], name: str) -> Optional[np.ndarray]:
+        if self.cache is None or key is None:
+            return None
+        return self.cache.load(key, name)
+
+    def saveCached(self, key: Optional[str], name: str, array: np.ndarray):
+        if self.cache is not None and key is not None:
+            self.cache.save(key, name, array)
+
+    @staticmethod
+    def remapLabels(labelVolume: np.ndarray, labelLookup: np.ndarray, labelType) -> np.ndarray:
+        # Label values of the merged labelmap without a segment become background
+        lookup = labelLookup.astype(labelType)
+        if labelVolume.size and labelVolume.max() >= lookup.shape[0]:
+            lookup = np.pad(lookup, (0, int(labelVolume.max()) + 1 - lookup.shape[0]))
+        return lookup[labelVolume]
+
+    @staticmethod
+    def buildBrickOrigins(labelVolume: np.ndarray, brickSize: int) -> np.ndarray:
+        # Origins (x, y, z, 0) in voxels of the bricks with a non-zero dilated label, i.e. with a label
+        # within one voxel. labelVolume is in the NumPy (K, J, I) layout.
+        occupied = labelVolume != 0
+        # Separable 3x3x3 dilation, the same neighbourhood as the label dilation shaders
+        for axis in range(3):
+            dilated = occupied.copy()
+            lower = [slice(None)] * 3
+            upper = [slice(None)] * 3
+            lower[axis] = slice(None, -1)
+            upper[axis] = slice(1, None)
+            dilated[tuple(upper)] |= occupied[tuple(lower)]
+            dilated[tuple(lower)] |= occupied[tuple(upper)]
+            occupied = dilated
+
+        bricks = occupied
+        for axis in range(3):
+            bricks = np.logical_or.reduceat(bricks, np.arange(0, bricks.shape[axis], brickSize), axis=axis)
+
+        k, j, i = np.nonzero(bricks)
+        return (np.stack((i, j, k, np.zeros_like(i)), axis=1) * np.array([brickSize, brickSize, brickSize, 0])).astype(np.int32)
+
+    def labelImageFormat(self) -> str:
+        return self.LABEL_FORMATS[self.labelType][2]
+
+    @staticmethod
+    def buildLabelVolume(segmentationNode: vtkMRMLSegmentationNode) -> np.ndarray:
         # # 1. Get your segmentation node (by name, or just grab the first one)
         # segNode = self.logic.getParameterNode().segmentation  # replace with your node’s actual name
         # # segNode = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLSegmentationNode')
@@ -210,7 +521,7 @@ class Context:
 
         # 2. Generate it.  Use EXTENT_REFERENCE_GEOMETRY or another extent mode.
         #    EXTENT_REFERENCE_GEOMETRY will use the segmentation’s saved reference image geometry.
-        success = self.segmentation.GenerateMergedLabelmapForAllSegments(mergedLabelmap, slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY)
+        success = segmentationNode.GenerateMergedLabelmapForAllSegments(mergedLabelmap, slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY)
         
         if not success:
             raise RuntimeError("Failed to generate merged labelmap")
@@ -220,10 +531,17 @@ class Context:
         vtkScalars = mergedLabelmap.GetPointData().GetScalars()
         arr = numpy_support.vtk_to_numpy(vtkScalars)
         dims = mergedLabelmap.GetDimensions()
-        arr = arr.reshape(dims[0], dims[1], dims[2])
+        arr = arr.reshape(dims[2], dims[1], dims[0])
         # print("Multi-label shape:", arr.shape)
         
-        return Texture.fromArray(arr.astype(np.uint16), GL_R16UI, GL_RED_INTEGER, GL_UNSIGNED_SHORT, True)
+        return arr
+
+    def release(self):
+        # GL objects created by the context, the output texture belongs to VTK
+        self.outputTarget.release()
+        self.mask.release()
+        for texture in (self.labelToColorMapTex2d, self.labelVolumeTex3d, self.labelVolumeDilatedTex3d, self.intensityVolumeTex3d):
+            texture.release()
     
 
     def getViewIndex(self) -> int:
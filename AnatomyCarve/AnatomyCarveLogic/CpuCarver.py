@@ -0,0 +1,155 @@
+import os
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+# CPU implementation of FillColorVolume.comp and CarveVoxelsAA.comp, the reference of the GPU passes checked by
+# Benchmark.verify and the cpu engine of the benchmark. The module always carves on the GPU. Volumes use the
+# NumPy (K, J, I) layout returned by slicer.util.arrayFromVolume, i.e. GL texture coordinate (x, y, z) is
+# array index [z, y, x].
+class CpuCarver:
+    SLAB_DEPTH = 8
+    # Rows of the 27x27 neighbour comparison evaluated at once, bounds the temporary memory of the dilation
+    DILATION_CHUNK = 16384
+
+    # Same order as the neighbourhood loops (dz, dy, dx) of FillColorVolume.comp, ties depend on it
+    NEIGHBOUR_OFFSETS = np.array([(dz, dy, dx) for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1)])
+
+    # Same sample points as CarveVoxelsAA.comp, in (x, y, z)
+    SAMPLE_POINTS = np.array([
+        ( 0.0,  0.0,  0.0),
+        (-1.0, -1.0, -1.0),
+        ( 1.0,  1.0, -1.0),
+        ( 1.0, -1.0,  1.0),
+        (-1.0,  1.0,  1.0),
+    ], dtype=np.float32)
+
+    def __init__(self, labelVolume: np.ndarray, colorMap: np.ndarray, intensityVolume: np.ndarray, workers: Optional[int] = None) -> None:
+        if labelVolume.shape != intensityVolume.shape:
+            raise ValueError(f"Label volume {labelVolume.shape} and intensity volume {intensityVolume.shape} differ in size")
+
+        self.labelVolume = labelVolume
+        self.colorMap = np.asarray(colorMap, dtype=np.uint8).reshape(-1, 4)
+        self.intensityVolume = intensityVolume.astype(np.float32, copy=False)
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        self.labelVolumeDilated = None
+
+    @classmethod
+    def fromNodes(cls, intensityVolume, segmentation, workers: Optional[int] = None):
+        # Builds the same inputs as Context, without touching OpenGL
+        import slicer
+        from AnatomyCarveLogic.Context import Context
+
+        labelLookup = Context.buildLabelLookup(segmentation)
+        labelVolume = Context.remapLabels(Context.buildLabelVolume(segmentation), labelLookup, np.uint16)
+        dims = intensityVolume.GetImageData().GetDimensions()
+        labelVolume = labelVolume.reshape(dims[2], dims[1], dims[0])
+        colorMap = Context.buildLabelToColorMap(segmentation, labelLookup)
+        intensity = cls.normalizeIntensity(slicer.util.arrayFromVolume(intensityVolume))
+        return cls(labelVolume, colorMap, intensity, workers)
+
+    @staticmethod
+    def normalizeIntensity(data: np.ndarray) -> np.ndarray:
+        # Same normalization as Texture.fromVolumeNode
+        data = data.astype(np.float32)
+        min = data.min()
+        max = data.max()
+        return (data - min) / (max - min)
+
+    def slabs(self):
+        depth = self.labelVolume.shape[0]
+        slabDepth = max(1, min(self.SLAB_DEPTH, -(-depth // self.workers)))
+        return [(z0, min(z0 + slabDepth, depth)) for z0 in range(0, depth, slabDepth)]
+
+    def runSlabs(self, function):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for _ in executor.map(lambda slab: function(*slab), self.slabs()):
+                pass
+
+    # Equivalent of FillColorVolume.comp: labelled voxels keep their label, background voxels take the most
+    # frequent non-zero label of their 3x3x3 neighbourhood (clamped to the volume)
+    def dilateLabels(self) -> np.ndarray:
+        self.labelVolumeDilated = np.empty_like(self.labelVolume)
+        self.runSlabs(self.dilateSlab)
+        return self.labelVolumeDilated
+
+    def dilateSlab(self, z0: int, z1: int):
+        depth = self.labelVolume.shape[0]
+        zLow, zHigh = max(z0 - 1, 0), min(z1 + 1, depth)
+        block = self.labelVolume[zLow:zHigh]
+        padded = np.pad(block, ((1 if z0 == 0 else 0, 1 if z1 == depth else 0), (1, 1), (1, 1)), mode="edge")
+
+        slab = self.labelVolume[z0:z1]
+        dilated = slab.copy()
+
+        # Only background voxels touching a label need the neighbourhood histogram
+        neighbourMax = np.zeros(slab.shape, dtype=slab.dtype)
+        for dz, dy, dx in self.NEIGHBOUR_OFFSETS:
+            np.maximum(neighbourMax, self.neighbours(padded, slab.shape, dz, dy, dx), out=neighbourMax)
+        z, y, x = np.nonzero((slab == 0) & (neighbourMax != 0))
+
+        for start in range(0, z.shape[0], self.DILATION_CHUNK):
+            cz, cy, cx = (a[start:start + self.DILATION_CHUNK] for a in (z, y, x))
+            values = np.stack([padded[cz + 1 + dz, cy + 1 + dy, cx + 1 + dx] for dz, dy, dx in self.NEIGHBOUR_OFFSETS], axis=1)
+            counts = (values[:, :, None] == values[:, None, :]).sum(axis=2)
+            counts[values == 0] = 0
+            # argmax returns the first neighbour with the highest count, i.e. the label seen first by the shader
+            best = np.argmax(counts, axis=1)
+            dilated[cz, cy, cx] = values[np.arange(values.shape[0]), best]
+
+        self.labelVolumeDilated[z0:z1] = dilated
+
+    @staticmethod
+    def neighbours(padded: np.ndarray, shape, dz: int, dy: int, dx: int) -> np.ndarray:
+        return padded[1 + dz:1 + dz + shape[0], 1 + dy:1 + dy + shape[1], 1 + dx:1 + dx + shape[2]]
+
+    # Equivalent of CarveVoxelsAA.comp. mask holds one row per sphere with 1 for visible (dense) labels and 0 for
+    # carved ones, spheres holds (x, y, z, radius) in RAS, modelMatrix maps IJK to RAS. Returns RGBA32F.
+    def carve(self, mask: np.ndarray, spheres: np.ndarray, modelMatrix: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+        if self.labelVolumeDilated is None:
+            self.dilateLabels()
+        if out is None:
+            out = np.empty(self.labelVolume.shape + (4,), dtype=np.float32)
+
+        spheres = np.asarray(spheres, dtype=np.float32).reshape(-1, 4)
+        segmentIsCarved = np.asarray(mask)[:spheres.shape[0]] == 0
+        modelMatrix = np.asarray(modelMatrix, dtype=np.float32)
+
+        self.runSlabs(lambda z0, z1: self.carveSlab(z0, z1, segmentIsCarved, spheres, modelMatrix, out))
+        return out
+
+    def carveSlab(self, z0: int, z1: int, segmentIsCarved: np.ndarray, spheres: np.ndarray, modelMatrix: np.ndarray, out: np.ndarray):
+        labels = self.labelVolumeDilated[z0:z1]
+        outSlab = out[z0:z1]
+        outSlab[...] = 0.0
+
+        z, y, x = np.nonzero(labels)
+        voxelLabels = labels[z, y, x]
+        coords = np.stack((x, y, z + z0), axis=1).astype(np.float32)
+
+        # The sample positions are the same for every sphere
+        samplePositions = [self.transformPoints(modelMatrix, coords + samplePoint) for samplePoint in self.SAMPLE_POINTS]
+
+        clipped = np.zeros((self.SAMPLE_POINTS.shape[0], coords.shape[0]), dtype=bool)
+        for i in range(spheres.shape[0]):
+            carved = segmentIsCarved[i][voxelLabels]
+            if not carved.any():
+                continue
+            for s, pos in enumerate(samplePositions):
+                distance = np.sqrt(((pos - spheres[i, :3]) ** 2).sum(axis=1, dtype=np.float32))
+                clipped[s] |= carved & (distance < spheres[i, 3])
+
+        visibleSamples = (~clipped).sum(axis=0)
+        opacityAA = visibleSamples.astype(np.float32) / np.float32(self.SAMPLE_POINTS.shape[0])
+
+        # GPUs convert unorm8 texels with a multiplication by the reciprocal
+        color = self.colorMap[voxelLabels].astype(np.float32) * np.float32(1.0 / 255.0)
+        color[:, 3] = self.intensityVolume[z0:z1][z, y, x] * opacityAA
+        outSlab[z, y, x] = color
+
+    @staticmethod
+    def transformPoints(modelMatrix: np.ndarray, points: np.ndarray) -> np.ndarray:
+        homogeneous = points @ modelMatrix[:3, :3].T + modelMatrix[:3, 3]
+        w = points @ modelMatrix[3, :3] + modelMatrix[3, 3]
+        return homogeneous / w[:, None]
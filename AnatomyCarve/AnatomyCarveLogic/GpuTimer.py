@@ -0,0 +1,99 @@
+import time
+import numpy as np
+
+from OpenGL.GL import *
+
+from collections import deque
+from typing import Optional
+
+class GpuTimer:
+    # GL_TIME_ELAPSED queries per pass, read back without stalling: every pass cycles through a small ring of
+    # query objects and collect() only reads the results the GPU already made available
+    RING_SIZE = 4
+    # Samples kept per pass for the statistics, in milliseconds
+    HISTORY_SIZE = 256
+
+    def __init__(self, csvPath: Optional[str] = None) -> None:
+        self.freeQueries = {}
+        self.pendingQueries = {}
+        self.samples = {}
+        # (pass name, query) being measured, time elapsed queries cannot be nested
+        self.activePass = None
+        # Every collected sample is appended as "pass,milliseconds,unix time"
+        self.csvPath = csvPath
+        if csvPath:
+            with open(csvPath, mode="w", encoding="utf-8") as f:
+                f.write("pass,milliseconds,time\n")
+
+    def begin(self, name: str) -> bool:
+        # Returns False when the pass is not measured: inside another pass, or with all its queries in flight
+        if self.activePass is not None:
+            return False
+        if name not in self.freeQueries:
+            self.freeQueries[name] = [int(query) for query in np.atleast_1d(glGenQueries(self.RING_SIZE))]
+            self.pendingQueries[name] = deque()
+            self.samples.setdefault(name, deque(maxlen=self.HISTORY_SIZE))
+
+        if not self.freeQueries[name]:
+            self.collect()
+            if not self.freeQueries[name]:
+                return False
+
+        query = self.freeQueries[name].pop()
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        self.activePass = (name, query)
+        return True
+
+    def end(self):
+        if self.activePass is None:
+            return
+        glEndQuery(GL_TIME_ELAPSED)
+        name, query = self.activePass
+        self.pendingQueries[name].append(query)
+        self.activePass = None
+
+    def collect(self):
+        collected = []
+        for name, queries in self.pendingQueries.items():
+            while queries:
+                available = GLuint(0)
+                glGetQueryObjectuiv(queries[0], GL_QUERY_RESULT_AVAILABLE, available)
+                if not available.value:
+                    break
+                query = queries.popleft()
+                elapsed = GLuint64(0)
+                glGetQueryObjectui64v(query, GL_QUERY_RESULT, elapsed)
+                self.freeQueries[name].append(query)
+                milliseconds = elapsed.value / 1e6
+                self.samples[name].append(milliseconds)
+                collected.append((name, milliseconds))
+
+        if self.csvPath and collected:
+            now = time.time()
+            with open(self.csvPath, mode="a", encoding="utf-8") as f:
+                f.writelines(f"{name},{milliseconds:.6f},{now:.3f}\n" for name, milliseconds in collected)
+
+    def stats(self) -> dict:
+        # last, mean and 95th percentile GPU time of every pass, in milliseconds
+        result = {}
+        for name, samples in self.samples.items():
+            if not samples:
+                continue
+            values = np.fromiter(samples, dtype=np.float64)
+            result[name] = {
+                "count": len(values),
+                "lastMs": float(values[-1]),
+                "meanMs": float(values.mean()),
+                "p95Ms": float(np.percentile(values, 95)),
+            }
+        return result
+
+    def release(self):
+        # Samples of the queries that completed are kept
+        self.collect()
+        queries = [query for free in self.freeQueries.values() for query in free]
+        queries += [query for pending in self.pendingQueries.values() for query in pending]
+        if queries:
+            glDeleteQueries(len(queries), queries)
+        self.freeQueries = {}
+        self.pendingQueries = {}
@@ -0,0 +1,238 @@
+import json
+import time
+import slicer
+import numpy as np
+
+from OpenGL.GL import *
+
+import vtk
+
+from typing import List, Optional
+
+from AnatomyCarveLogic.Profiler import *
+
+from slicer import vtkMRMLMarkupsNode
+
+class InteractionTrace:
+    # Timestamped session of AnatomyCarveLogic: sphere adds, removes and moves, radius changes, sphere
+    # selections, segment visibility toggles and interaction begin/end, replayed without a user to measure
+    # the latency of every event. Recording starts after startRender, the state at that point is stored
+    # with the events and restored before replaying them.
+    VERSION = 1
+    EVENT_TYPES = ("addSphere", "removeSphere", "moveSphere", "sphereRadius", "selectSphere", "segmentVisibility", "beginInteraction", "endInteraction")
+
+    def __init__(self, events: Optional[List[dict]] = None, initialState: Optional[dict] = None) -> None:
+        self.events = events if events is not None else []
+        self.initialState = initialState
+        self.logic = None
+        self.startTime = None
+        self.observations = []
+        # Last recorded sphere positions and segment visibilities, the node events only tell that something changed
+        self.spherePositions = []
+        self.segmentVisibilities = {}
+
+    def startRecording(self, logic):
+        self.stopRecording()
+        self.logic = logic
+        self.events = []
+        self.initialState = self.captureState(logic)
+        self.spherePositions = self.getSpherePositions(logic)
+        self.segmentVisibilities = dict(self.initialState["segmentVisibilities"])
+        self.startTime = time.perf_counter()
+        # The radius, selection and add/remove events go through the logic, see AnatomyCarveLogic.recordInteraction
+        logic.interactionTrace = self
+        displayNode = logic.context.segmentation.GetDisplayNode()
+        self.observations = [
+            (logic.clippingSpheresNode, logic.clippingSpheresNode.AddObserver(vtkMRMLMarkupsNode.PointModifiedEvent, self.onSpheresModified)),
+            (displayNode, displayNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSegmentationDisplayModified)),
+        ]
+
+    def stopRecording(self):
+        for observedObject, tag in self.observations:
+            observedObject.RemoveObserver(tag)
+        self.observations = []
+        if self.logic is not None and self.logic.interactionTrace is self:
+            self.logic.interactionTrace = None
+        self.logic = None
+
+    def isRecording(self) -> bool:
+        return self.logic is not None
+
+    def record(self, eventType: str, **data):
+        if not self.isRecording():
+            return
+        if eventType not in self.EVENT_TYPES:
+            raise ValueError(f"Unknown interaction event {eventType}")
+        self.events.append(dict(time=time.perf_counter() - self.startTime, type=eventType, **data))
+        if eventType in ("addSphere", "removeSphere"):
+            self.spherePositions = self.getSpherePositions(self.logic)
+
+    def onSpheresModified(self, caller, event):
+        positions = self.getSpherePositions(self.logic)
+        # Adds and removes are recorded by the logic, with the radius of the sphere
+        if len(positions) == len(self.spherePositions):
+            for index, (old, new) in enumerate(zip(self.spherePositions, positions)):
+                if old != new:
+                    self.record("moveSphere", index=index, position=new)
+        self.spherePositions = positions
+
+    def onSegmentationDisplayModified(self, caller, event):
+        visibilities = self.getSegmentVisibilities(self.logic)
+        # Visibilities pushed by a sphere selection are replayed by the selection itself
+        if not self.logic.context.mask.selectingSphere:
+            for segmentID, visible in visibilities.items():
+                if self.segmentVisibilities.get(segmentID) != visible:
+                    self.record("segmentVisibility", segmentID=segmentID, visible=visible)
+        self.segmentVisibilities = visibilities
+
+    @staticmethod
+    def getSpherePositions(logic) -> List[List[float]]:
+        node = logic.clippingSpheresNode
+        positions = []
+        for i in range(node.GetNumberOfControlPoints()):
+            position = [0.0, 0.0, 0.0]
+            node.GetNthControlPointPosition(i, position)
+            positions.append(position)
+        return positions
+
+    @staticmethod
+    def getSegmentVisibilities(logic) -> dict:
+        segmentationNode = logic.context.segmentation
+        segmentation = segmentationNode.GetSegmentation()
+        displayNode = segmentationNode.GetDisplayNode()
+        segmentIDs = [segmentation.GetNthSegmentID(i) for i in range(segmentation.GetNumberOfSegments())]
+        return {segmentID: bool(displayNode.GetSegmentVisibility(segmentID)) for segmentID in segmentIDs}
+
+    @classmethod
+    def captureState(cls, logic) -> dict:
+        node = logic.clippingSpheresNode
+        return {
+            "spherePositions": cls.getSpherePositions(logic),
+            "sphereRadiuses": [logic.sphereRadiuses[node.GetNthControlPointID(i)] for i in range(node.GetNumberOfControlPoints())],
+            "maskRows": logic.context.mask.rows[:logic.context.mask.sphereCount].tolist(),
+            "selectedSphereIndex": logic.context.mask.selectedSphereIndex,
+            "segmentVisibilities": cls.getSegmentVisibilities(logic),
+        }
+
+    @classmethod
+    def restoreState(cls, logic, state: dict):
+        node = logic.clippingSpheresNode
+        while node.GetNumberOfControlPoints() > len(state["spherePositions"]):
+            cls.applyEvent(logic, {"type": "removeSphere"})
+        while node.GetNumberOfControlPoints() < len(state["spherePositions"]):
+            cls.applyEvent(logic, {"type": "addSphere", "position": [0.0, 0.0, 0.0], "radius": 0.0})
+        for index, (position, radius) in enumerate(zip(state["spherePositions"], state["sphereRadiuses"])):
+            node.SetNthControlPointPosition(index, *position)
+            logic.sphereRadiuses[node.GetNthControlPointID(index)] = radius
+
+        displayNode = logic.context.segmentation.GetDisplayNode()
+        wasModifying = displayNode.StartModify()
+        for segmentID, visible in state["segmentVisibilities"].items():
+            displayNode.SetSegmentVisibility(segmentID, visible)
+        displayNode.EndModify(wasModifying)
+
+        # The rows of the other spheres do not follow the display node, they are written directly
+        mask = logic.context.mask
+        for index, row in enumerate(state["maskRows"]):
+            mask.writeRow(index, np.array(row, dtype=np.int32))
+        if state["selectedSphereIndex"] >= 0:
+            logic.changeSelctedPointIndex(state["selectedSphereIndex"])
+
+    @staticmethod
+    def applyEvent(logic, event: dict):
+        # Same calls as the module widget makes for the user action. Adds and removes go through the node,
+        # the logic is only called when no widget observes the node.
+        node = logic.clippingSpheresNode
+        eventType = event["type"]
+        if eventType == "addSphere":
+            node.AddControlPoint(event["position"])
+            pointID = node.GetNthControlPointID(node.GetNumberOfControlPoints() - 1)
+            if pointID not in logic.sphereRadiuses:
+                logic.addLastClippingSphere(event["radius"])
+            logic.sphereRadiuses[pointID] = event["radius"]
+        elif eventType == "removeSphere":
+            node.RemoveNthControlPoint(node.GetNumberOfControlPoints() - 1)
+            if len(logic.sphereRadiuses) > node.GetNumberOfControlPoints():
+                logic.removeLastClippingSphere()
+        elif eventType == "moveSphere":
+            node.SetNthControlPointPosition(event["index"], *event["position"])
+        elif eventType == "sphereRadius":
+            logic.updateClippingSphereRadius(event["radius"])
+        elif eventType == "selectSphere":
+            logic.changeSelctedPointIndex(event["index"])
+        elif eventType == "segmentVisibility":
+            logic.context.segmentation.GetDisplayNode().SetSegmentVisibility(event["segmentID"], event["visible"])
+        elif eventType == "beginInteraction":
+            logic.beginInteraction()
+        elif eventType == "endInteraction":
+            logic.endInteraction()
+        else:
+            raise ValueError(f"Unknown interaction event {eventType}")
+
+    def replay(self, logic, speed: Optional[float] = None) -> dict:
+        # Applies the events to a started logic and renders after each one. speed None replays as fast as
+        # possible, 1.0 keeps the recorded pace (the waits are not counted in the latencies).
+        renderWindow = slicer.app.layoutManager().threeDWidget(logic.context.getViewIndex()).threeDView().renderWindow()
+        frames = [0]
+        observerTag = renderWindow.AddObserver(vtk.vtkCommand.StartEvent, lambda caller, event: frames.__setitem__(0, frames[0] + 1))
+        latencies = []
+        try:
+            if self.initialState is not None:
+                self.restoreState(logic, self.initialState)
+            logic.forceRender()
+            glFinish()
+            frames[0] = 0
+
+            startTime = time.perf_counter()
+            for event in self.events:
+                if speed:
+                    while time.perf_counter() - startTime < event["time"] / speed:
+                        slicer.app.processEvents()
+                eventStartTime = time.perf_counter()
+                self.applyEvent(logic, event)
+                logic.forceRender()
+                glFinish()
+                latencies.append((event["type"], time.perf_counter() - eventStartTime))
+            totalSeconds = time.perf_counter() - startTime
+        finally:
+            renderWindow.RemoveObserver(observerTag)
+
+        return self.buildReport(latencies, frames[0], totalSeconds)
+
+    @staticmethod
+    def buildReport(latencies: list, frames: int, totalSeconds: float) -> dict:
+        def stats(milliseconds: np.ndarray) -> dict:
+            return {
+                "count": int(milliseconds.shape[0]),
+                "meanMs": float(milliseconds.mean()),
+                "p95Ms": float(np.percentile(milliseconds, 95)),
+                "maxMs": float(milliseconds.max()),
+            }
+
+        report = {
+            "events": len(latencies),
+            "frames": frames,
+            "totalSeconds": totalSeconds,
+            "eventLatenciesMs": [seconds * 1000.0 for _, seconds in latencies],
+            "latencies": {},
+        }
+        if latencies:
+            milliseconds = np.array([seconds for _, seconds in latencies]) * 1000.0
+            eventTypes = np.array([eventType for eventType, _ in latencies])
+            report["latencies"]["all"] = stats(milliseconds)
+            for eventType in dict.fromkeys(eventTypes.tolist()):
+                report["latencies"][eventType] = stats(milliseconds[eventTypes == eventType])
+        report["profile"] = Profiler.asDict() if Profiler.enabled else None
+        return report
+
+    def save(self, path: str):
+        with open(path, mode="w", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, "initialState": self.initialState, "events": self.events}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, mode="r", encoding="utf-8") as f:
+            trace = json.load(f)
+        if trace.get("version") != cls.VERSION:
+            raise ValueError(f"Unsupported interaction trace version {trace.get('version')}")
+        return cls(trace["events"], trace["initialState"])
@@ -6,6 +6,7 @@ import numpy as np
 from OpenGL.GL import *
 
 from AnatomyCarveLogic.Texture import *
+from AnatomyCarveLogic.StorageBuffer import *
 
 from slicer import vtkMRMLSegmentationNode
 
@@ -18,10 +19,12 @@ from slicer import vtkMRMLSegmentationNode
 # import traceback
 
 class Mask:
-    MAX_SPHERES = 32    
+    # Rows allocated up front, the buffer doubles whenever more spheres are added
+    INITIAL_SPHERE_CAPACITY = 32
+    SPHERES_PER_WORD = 32
     NEW_POINT_MASK_BASED_ON_SELECTED_ROW = True
 
-    def __init__(self, segmentation: vtkMRMLSegmentationNode, sphereCount: int) -> None:
+    def __init__(self, segmentation: vtkMRMLSegmentationNode, sphereCount: int, labelLookup: np.ndarray) -> None:
         # # get the first 3D view’s VTK render window
         # rv = slicer.app.layoutManager().threeDWidget(0).threeDView().renderWindow()
         # # force the OpenGL context to be current here
@@ -42,33 +45,81 @@ class Mask:
         #     print("No current GL context (or context invalid); glGetError() →", err)
 
         self.segmentation = segmentation
-        self.texture = self.createTexture()
+        # Dense label of each segment label value, see Context.buildLabelLookup
+        self.labelLookup = labelLookup
+        self.buffer = self.createBuffer()
+        self.updateSegmentIndex()
+        # Set while selectSphere() pushes a row to the display node, its visibility events must not write back
+        self.selectingSphere = False
+        # Visibility currently shown by the display node, per label
+        self.displayedRow = None
+        # Authoritative copy of the mask, the GPU buffer is only ever written from it
+        self.rows = np.ones((self.INITIAL_SPHERE_CAPACITY, self.labelCount), dtype=np.uint8)
         self.sphereCount = sphereCount
         self.selectedSphereIndexPrevious = -1
         self.selectedSphereIndex = -1
+        # Rows changed since the last popDirtyRows(), and words not uploaded yet by flush()
+        self.dirtyRows = set()
+        self.dirtyWords = set()
+        # Incremented on every change of the mask content
+        self.generation = 0
         # self.update()
 
-    def createTexture(self):
+    def createBuffer(self):
+        # Bit i of word [w * labelCount + label] is set when sphere 32 * w + i carves the dense label.
+        # The rows exposed by this class keep 1 for visible labels and 0 for carved ones.
+        self.labelCount = int(self.labelLookup.max()) + 1
+        return StorageBuffer(np.uint32, self.labelCount * self.wordCount(self.INITIAL_SPHERE_CAPACITY), 0)
+
+    def updateSegmentIndex(self):
+        # Segment IDs and their label values, refreshed only when segments are added, removed or modified
         segmentation = self.segmentation.GetSegmentation()
-        segmentIDs = segmentation.GetSegmentIDs()  
+        # Segments created after the label volume was built have no voxels in it and are left out
+        segmentIDs = [segmentation.GetNthSegmentID(i) for i in range(segmentation.GetNumberOfSegments())]
+        labelValues = [segmentation.GetSegment(segmentID).GetLabelValue() for segmentID in segmentIDs]
+        labels = [int(self.labelLookup[value]) if 0 <= value < self.labelLookup.shape[0] else 0 for value in labelValues]
+        self.segmentIDs = [segmentID for segmentID, label in zip(segmentIDs, labels) if label != 0]
+        self.segmentLabels = np.array([label for label in labels if label != 0], dtype=np.int64)
+
+    def wordCount(self, sphereCount: int) -> int:
+        return -(-sphereCount // self.SPHERES_PER_WORD)
+
+    def packWords(self, firstWord: int, lastWord: int) -> np.ndarray:
+        # Words [firstWord, lastWord] of every label, in buffer order
+        rows = self.rows[firstWord * self.SPHERES_PER_WORD:(lastWord + 1) * self.SPHERES_PER_WORD]
+        return self.packRows(rows, lastWord + 1 - firstWord)
 
-        maxLabel = max(
-            segmentation.GetSegment(segID).GetLabelValue() # vtkSegment::GetLabelValue 
-            for segID in segmentIDs
-        )
-        return Texture.fromArray(np.ones((maxLabel + 1, self.MAX_SPHERES), dtype=np.int32), GL_R8UI, GL_RED_INTEGER, GL_UNSIGNED_BYTE, True)
+    @classmethod
+    def packRows(cls, rows: np.ndarray, wordCount: int) -> np.ndarray:
+        # Packs (sphere, label) rows into wordCount words per label, missing spheres carve nothing
+        labelCount = rows.shape[1]
+        rows = np.pad(rows, ((0, wordCount * cls.SPHERES_PER_WORD - rows.shape[0]), (0, 0)), constant_values=1)
+        carved = (rows == 0).reshape(-1, cls.SPHERES_PER_WORD, labelCount).astype(np.uint32)
+        bits = np.left_shift(np.uint32(1), np.arange(cls.SPHERES_PER_WORD, dtype=np.uint32))
+        return np.bitwise_or.reduce(carved * bits[None, :, None], axis=1)
+
+    def readRow(self, rowIndex: int) -> np.ndarray:
+        return self.rows[rowIndex].astype(np.int32)
     
+    def ensureRowCapacity(self, rowCount: int):
+        if rowCount <= self.rows.shape[0]:
+            return
+        rows = np.ones((max(rowCount, 2 * self.rows.shape[0]), self.labelCount), dtype=np.uint8)
+        rows[:self.rows.shape[0]] = self.rows
+        self.rows = rows
+
     def addSphere(self):
         self.sphereCount += 1
+        self.ensureRowCapacity(self.sphereCount)
         
         if self.sphereCount == 1:
             self.updateRowFromSegmentation(0)
         else:
             if self.NEW_POINT_MASK_BASED_ON_SELECTED_ROW:
-                rowMask = self.texture.readRow2d(self.selectedSphereIndex)
+                rowMask = self.readRow(self.selectedSphereIndex)
             else:
-                rowMask = self.texture.readRow2d(self.sphereCount - 2)
-            self.texture.updateRow2d(self.sphereCount - 1, rowMask)
+                rowMask = self.readRow(self.sphereCount - 2)
+            self.writeRow(self.sphereCount - 1, rowMask)
         
         self.selectedSphereIndexPrevious = self.selectedSphereIndex
         self.selectSphere(self.sphereCount - 1)
@@ -89,17 +140,27 @@ class Mask:
         
         self.selectedSphereIndex = index
         
-        rowMask = self.texture.readRow2d(index)
+        rowMask = self.readRow(index)
         
-        segmentation = self.segmentation.GetSegmentation()
         displayNode = self.segmentation.GetDisplayNode()
 
-        for i in range(segmentation.GetNumberOfSegments()):
-            segmentID = segmentation.GetNthSegmentID(i)
-            segment = segmentation.GetSegment(segmentID)
-            labelValue = segment.GetLabelValue()
-            visibility = rowMask[labelValue] == 1
-            displayNode.SetSegmentVisibility(segmentID, visibility)
+        # Only the segments whose visibility differs from the displayed row are touched
+        if self.displayedRow is None:
+            changedSegments = range(len(self.segmentIDs))
+        else:
+            changedSegments = np.nonzero(rowMask[self.segmentLabels] != self.displayedRow[self.segmentLabels])[0]
+
+        self.selectingSphere = True
+        wasModifying = displayNode.StartModify()
+        try:
+            for i in changedSegments:
+                visibility = rowMask[self.segmentLabels[i]] == 1
+                displayNode.SetSegmentVisibility(self.segmentIDs[i], visibility)
+        finally:
+            # A single Modified event is invoked here, for all the changed segments
+            displayNode.EndModify(wasModifying)
+            self.selectingSphere = False
+        self.displayedRow = rowMask
     
     def removeSphere(self):
         if self.sphereCount <= 0:
@@ -153,22 +214,46 @@ class Mask:
         # Get the currently selected segmentation node
         #segmentation = self.getParameterNode().segmentation  # Replace with your actual node name if needed
         
-        segmentation = self.segmentation.GetSegmentation()
+        if self.selectingSphere:
+            return
+
         displayNode = self.segmentation.GetDisplayNode()
         #segmentIDs = segmentation.GetSegmentIDs()  
 
         # segmentInfoArray = []
         # self.clipMask = np.zeros((maxLabel + 1))
 
-        rowMask = np.zeros((self.texture.dims[0]), dtype=np.int32)
-
-        for i in range(segmentation.GetNumberOfSegments()):
-            segmentID = segmentation.GetNthSegmentID(i)
-            segment = segmentation.GetSegment(segmentID)
-            isVisible = displayNode.GetSegmentVisibility(segmentID)
-            labelValue = segment.GetLabelValue()
-            rowMask[labelValue] = 1 if bool(isVisible) else 0
+        rowMask = np.zeros((self.labelCount), dtype=np.int32)
+        rowMask[self.segmentLabels] = [1 if bool(displayNode.GetSegmentVisibility(segmentID)) else 0 for segmentID in self.segmentIDs]
+        self.displayedRow = rowMask
 
         # print(rowMask)
         if self.sphereCount >= 1:
-            self.texture.updateRow2d(rowIndex, rowMask)
\ No newline at end of file
+            self.writeRow(rowIndex, rowMask)
+
+    def writeRow(self, rowIndex: int, rowMask: np.ndarray):
+        self.ensureRowCapacity(rowIndex + 1)
+        if np.array_equal(self.rows[rowIndex], rowMask):
+            return
+
+        self.rows[rowIndex] = rowMask
+        self.dirtyRows.add(rowIndex)
+        self.dirtyWords.add(rowIndex // self.SPHERES_PER_WORD)
+        self.generation += 1
+
+    def flush(self):
+        # Uploads the words changed since the last flush in a single call, the buffer is never read back
+        if not self.dirtyWords:
+            return
+        firstWord = min(self.dirtyWords)
+        lastWord = max(self.dirtyWords)
+        self.buffer.upload(self.packWords(firstWord, lastWord), firstWord * self.labelCount)
+        self.dirtyWords = set()
+
+    def popDirtyRows(self) -> set:
+        dirtyRows = self.dirtyRows
+        self.dirtyRows = set()
+        return dirtyRows
+
+    def release(self):
+        self.buffer.release()
\ No newline at end of file
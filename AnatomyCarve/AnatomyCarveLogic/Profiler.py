@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+class Profiler:
+    # Process wide registry of phase timings and GL traffic counters, disabled by default. While disabled,
+    # phase() returns a shared no-op context manager and count() returns right away.
+    enabled = False
+    # name -> (calls, total seconds, max seconds)
+    phases = {}
+    counters = {}
+    NO_PHASE = nullcontext()
+    # Phases are also timed on the volume preparation threads, see Context
+    lock = threading.Lock()
+
+    @classmethod
+    def enable(cls, enabled: bool = True):
+        cls.enabled = enabled
+
+    @classmethod
+    def reset(cls):
+        cls.phases = {}
+        cls.counters = {}
+
+    @classmethod
+    def phase(cls, name: str):
+        if not cls.enabled:
+            return cls.NO_PHASE
+        return cls.timePhase(name)
+
+    @classmethod
+    @contextmanager
+    def timePhase(cls, name: str):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.addPhase(name, time.perf_counter() - startTime)
+
+    @classmethod
+    def addPhase(cls, name: str, seconds: float):
+        with cls.lock:
+            calls, totalSeconds, maxSeconds = cls.phases.get(name, (0, 0.0, 0.0))
+            cls.phases[name] = (calls + 1, totalSeconds + seconds, max(maxSeconds, seconds))
+
+    @classmethod
+    def count(cls, name: str, amount: int = 1):
+        if cls.enabled:
+            with cls.lock:
+                cls.counters[name] = cls.counters.get(name, 0) + amount
+
+    @classmethod
+    def asDict(cls) -> dict:
+        return {
+            "phases": {
+                name: {
+                    "calls": calls,
+                    "totalSeconds": totalSeconds,
+                    "meanSeconds": totalSeconds / calls,
+                    "maxSeconds": maxSeconds,
+                }
+                for name, (calls, totalSeconds, maxSeconds) in cls.phases.items()
+            },
+            "counters": dict(cls.counters),
+        }
+
+    @classmethod
+    def toJson(cls, path: Optional[str] = None) -> str:
+        text = json.dumps(cls.asDict(), indent=2)
+        if path:
+            with open(path, mode="w", encoding="utf-8") as f:
+                f.write(text)
+        return text
@@ -0,0 +1,64 @@
+import logging
+import numpy as np
+
+from OpenGL.GL import *
+
+from AnatomyCarveLogic.Profiler import *
+
+# Shader storage buffer holding a flat array of `dtype` items, grown on demand
+class StorageBuffer:
+
+    def __init__(self, dtype, capacity: int, fillValue=0) -> None:
+        self.dtype = np.dtype(dtype)
+        self.fillValue = fillValue
+        self.bufferId = None
+        self.capacity = 0
+        self.resize(max(1, capacity))
+
+    def resize(self, capacity: int):
+        # Reallocates the buffer, the existing items are kept and the new ones set to fillValue
+        newBufferId = glGenBuffers(1).item()
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, newBufferId)
+        glBufferData(GL_SHADER_STORAGE_BUFFER, np.full(capacity, self.fillValue, dtype=self.dtype), GL_DYNAMIC_DRAW)
+
+        if self.bufferId is not None:
+            glBindBuffer(GL_COPY_READ_BUFFER, self.bufferId)
+            glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_SHADER_STORAGE_BUFFER, 0, 0, min(self.capacity, capacity) * self.dtype.itemsize)
+            glBindBuffer(GL_COPY_READ_BUFFER, 0)
+            glDeleteBuffers(1, [self.bufferId])
+
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+        self.bufferId = newBufferId
+        self.capacity = capacity
+
+    def ensureCapacity(self, count: int):
+        if count <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < count:
+            capacity *= 2
+        logging.debug(f"Growing storage buffer from {self.capacity} to {capacity} items")
+        self.resize(capacity)
+
+    def upload(self, data: np.ndarray, offset: int = 0):
+        data = np.ascontiguousarray(data, dtype=self.dtype).ravel()
+        if data.size == 0:
+            return
+        self.ensureCapacity(offset + data.size)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.bufferId)
+        glBufferSubData(GL_SHADER_STORAGE_BUFFER, offset * self.dtype.itemsize, data.nbytes, data)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+        Profiler.count("bufferBytesUploaded", data.nbytes)
+
+    def read(self, offset: int, count: int) -> np.ndarray:
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, self.bufferId)
+        rawData = glGetBufferSubData(GL_SHADER_STORAGE_BUFFER, offset * self.dtype.itemsize, count * self.dtype.itemsize)
+        glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+        Profiler.count("bufferBytesReadBack", count * self.dtype.itemsize)
+        return np.frombuffer(rawData, dtype=self.dtype).copy()
+
+    def release(self):
+        if self.bufferId is not None:
+            glDeleteBuffers(1, [self.bufferId])
+        self.bufferId = None
+        self.capacity = 0
@@ -5,6 +5,8 @@ import numpy as np
 
 from OpenGL.GL import *
 
+from AnatomyCarveLogic.Profiler import *
+
 from slicer import vtkMRMLScalarVolumeNode
 
 # class Texture2D:
@@ -25,6 +27,8 @@ from slicer import vtkMRMLScalarVolumeNode
 #         glTexSubImage3D(GL_TEXTURE_3D, 0, 0, 0, 0, *dims, GL_RED, GL_FLOAT, array.ravel())
 
 class Texture:
+    # Slices normalized and uploaded at once by fromVolumeNode
+    UPLOAD_SLAB_DEPTH = 16
     
     MAP_GL_TYPE_TO_NUMPY = {
         GL_UNSIGNED_BYTE: np.uint8,
@@ -51,21 +55,34 @@ class Texture:
     # Initialize from existing volume node 
     @classmethod
     def fromVolumeNode(cls, scalarVolumeNode: vtkMRMLScalarVolumeNode, internalformat: int, format: int, type: int, scale: float):
-        DEFAULT_TYPE = np.float32
-        
+        # Normalizes the volume to [0, scale] and streams it slab by slab, integer types are uploaded to
+        # normalized internal formats (e.g. GL_R16, GL_R8) and scaled to their full range
         t = cls()
-        data = slicer.util.arrayFromVolume(scalarVolumeNode).astype(DEFAULT_TYPE)
-        data = data.reshape(data.shape[::-1])
-        min = data.min()
-        max = data.max()
-        data = (data - min) / (max - min)
-        if scale != 1.0:
-            data = data * scale
-        if Texture.MAP_GL_TYPE_TO_NUMPY[type] != DEFAULT_TYPE:
-            data = data.astype(Texture.MAP_GL_TYPE_TO_NUMPY[type])
-        t.uploadData(data, internalformat, format, type, True)
+        data = slicer.util.arrayFromVolume(scalarVolumeNode)
+        t.allocate(data.shape[::-1], internalformat, format, type)
+        for z0, slab in cls.normalizedSlabs(data, type, scale):
+            t.uploadSlab(slab, z0)
         return t
 
+    @classmethod
+    def normalizedSlabs(cls, data: np.ndarray, type: int, scale: float):
+        # Yields (first slice, slab) of data normalized as by fromVolumeNode, in the NumPy type of the GL type
+        DEFAULT_TYPE = np.float32
+
+        min = float(data.min())
+        max = float(data.max())
+        dataType = Texture.MAP_GL_TYPE_TO_NUMPY[type]
+        if np.issubdtype(dataType, np.integer):
+            scale = scale * np.iinfo(dataType).max
+
+        for z0 in range(0, data.shape[0], cls.UPLOAD_SLAB_DEPTH):
+            slab = (data[z0:z0 + cls.UPLOAD_SLAB_DEPTH].astype(DEFAULT_TYPE) - DEFAULT_TYPE(min)) / DEFAULT_TYPE(max - min)
+            if scale != 1.0:
+                slab = slab * DEFAULT_TYPE(scale)
+            if dataType != DEFAULT_TYPE:
+                slab = np.rint(slab).astype(dataType)
+            yield z0, slab
+
     # Initialize from new data
     @classmethod
     def fromArray(cls, data: np.ndarray, internalformat: int, format: int, type: int, isScalarComponent: bool):
@@ -92,6 +109,7 @@ class Texture:
             glTexStorage2D(GL_TEXTURE_2D, 1, self.internalformat, *self.dims)
             glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, *self.dims, self.format, self.type, data.ravel())
             glBindTexture(GL_TEXTURE_2D, 0)
+            Profiler.count("textureBytesUploaded", data.nbytes)
         elif len(self.dims) == 3: #isScalarComponent and len(data.shape) == 3 or not isScalarComponent and len(data.shape) == 4:
             glBindTexture(GL_TEXTURE_3D, self.textureId)
             glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
@@ -99,9 +117,69 @@ class Texture:
             glTexStorage3D(GL_TEXTURE_3D, 1, self.internalformat, *self.dims)
             glTexSubImage3D(GL_TEXTURE_3D, 0, 0, 0, 0, *self.dims, self.format, self.type, data.ravel())
             glBindTexture(GL_TEXTURE_3D, 0)
+            Profiler.count("textureBytesUploaded", data.nbytes)
         else:
             logging.error(f"Arrays of dimension {len(data.shape)} are not supported")
 
+    def allocate(self, dims: tuple[int, int, int], internalformat: int, format: int, type: int):
+        # Empty 3D texture, filled afterwards with uploadSlab
+        self.dims = tuple(dims)
+        self.textureId = glGenTextures(1).item()
+        self.internalformat = internalformat
+        self.format = format
+        self.type = type
+
+        glBindTexture(GL_TEXTURE_3D, self.textureId)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_3D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexStorage3D(GL_TEXTURE_3D, 1, self.internalformat, *self.dims)
+        glBindTexture(GL_TEXTURE_3D, 0)
+
+    def uploadSlab(self, data: np.ndarray, zOffset: int):
+        # data holds whole slices in the NumPy (K, J, I) layout, starting at slice zOffset
+        data = np.ascontiguousarray(data)
+        glBindTexture(GL_TEXTURE_3D, self.textureId)
+        # Rows of 8 and 16 bit textures are not 4 byte aligned for odd widths
+        unpackAlignment = glGetIntegerv(GL_UNPACK_ALIGNMENT)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexSubImage3D(GL_TEXTURE_3D, 0, 0, 0, zOffset, self.dims[0], self.dims[1], data.shape[0], self.format, self.type, data.ravel())
+        glPixelStorei(GL_UNPACK_ALIGNMENT, unpackAlignment)
+        glBindTexture(GL_TEXTURE_3D, 0)
+        Profiler.count("textureBytesUploaded", data.nbytes)
+
+    def uploadSlabs(self, data: np.ndarray):
+        # Whole volume in the NumPy (K, J, I) layout, e.g. memory mapped, uploaded without a full copy
+        for z0 in range(0, data.shape[0], self.UPLOAD_SLAB_DEPTH):
+            self.uploadSlab(data[z0:z0 + self.UPLOAD_SLAB_DEPTH], z0)
+
+    def release(self):
+        # Only for the textures created by this module, VTK deletes the textures of its volume mappers
+        if self.textureId > 0:
+            glDeleteTextures(1, [self.textureId])
+        self.textureId = -1
+
+    def readData3d(self) -> np.ndarray:
+        # Whole 3D texture in the NumPy (K, J, I) layout, with the components last
+        glBindTexture(GL_TEXTURE_3D, self.textureId)
+        packAlignment = glGetIntegerv(GL_PACK_ALIGNMENT)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        rawData = glGetTexImage(GL_TEXTURE_3D, 0, self.format, self.type)
+        glPixelStorei(GL_PACK_ALIGNMENT, packAlignment)
+        glBindTexture(GL_TEXTURE_3D, 0)
+        Profiler.count("textureBytesReadBack", len(rawData))
+        data = np.frombuffer(rawData, dtype=Texture.MAP_GL_TYPE_TO_NUMPY[self.type])
+        data = data.reshape(tuple(self.dims[::-1]) + (-1,))
+        return data[..., 0] if data.shape[-1] == 1 else data
+
+    def updateData2d(self, data: np.ndarray):
+        # The texture is not reallocated, the data must have the shape it was created from by fromArray
+        assert data.shape[:2] == tuple(self.dims), f"Data of shape {data.shape} does not fit texture of size {self.dims}"
+        data = np.ascontiguousarray(data)
+        glBindTexture(GL_TEXTURE_2D, self.textureId)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, *self.dims, self.format, self.type, data.ravel())
+        glBindTexture(GL_TEXTURE_2D, 0)
+        Profiler.count("textureBytesUploaded", data.nbytes)
+
     def updateRow2d(self, rowIndex: int, newRow: np.ndarray):
         # print(f"type(self.textureId): {type(self.textureId)}")
         # print(f"bool(glIsTexture(self.textureId)): {bool(glIsTexture(int(self.textureId)))}")
@@ -119,6 +197,7 @@ class Texture:
             self.type,      # type
             newRow.ravel()               # numpy array with shape (width,)
         )
+        Profiler.count("textureBytesUploaded", newRow.nbytes)
 
         glBindTexture(GL_TEXTURE_2D, 0)
         
@@ -127,6 +206,7 @@ class Texture:
         
         # 3. Pull back the data as raw bytes
         rawData = glGetTexImage(GL_TEXTURE_2D, 0, self.format, self.type)
+        Profiler.count("textureBytesReadBack", len(rawData))
         
         # glGetTexSubImage(
         #     GL_TEXTURE_2D,
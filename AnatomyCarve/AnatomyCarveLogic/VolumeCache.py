@@ -0,0 +1,131 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import numpy as np
+
+from contextlib import contextmanager
+from typing import Optional
+
+class VolumeCache:
+    # Content addressed store of derived volumes: every entry is a directory named after the hash of the
+    # inputs, holding one memory mappable .npy file per volume. Entries are evicted least recently used
+    # first once the directory grows over maxBytes, the modification time of an entry is its last use.
+    DEFAULT_MAX_BYTES = 8 * 1024 ** 3
+    DIRECTORY_NAME = "AnatomyCarve"
+    # Changing the layout or the content of the cached volumes must bump this, it is part of every key
+    VERSION = 1
+
+    def __init__(self, directory: str, maxBytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.directory = directory
+        self.maxBytes = maxBytes
+        # Volumes are written from several preparation threads, see Context
+        self.evictLock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def default(cls, maxBytes: int = DEFAULT_MAX_BYTES):
+        import slicer
+        return cls(os.path.join(slicer.app.cachePath, cls.DIRECTORY_NAME), maxBytes)
+
+    @classmethod
+    def hashKey(cls, *parts) -> str:
+        # parts are arrays (hashed by content, shape and type), strings or any value with a stable repr
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"v{cls.VERSION}".encode())
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                digest.update(f"{part.dtype.str}{part.shape}".encode())
+                digest.update(memoryview(np.ascontiguousarray(part)).cast("B"))
+            elif isinstance(part, (bytes, bytearray, memoryview)):
+                digest.update(part)
+            else:
+                digest.update(repr(part).encode())
+            # Separator, ("ab", "c") and ("a", "bc") differ
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def entryPath(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def filePath(self, key: str, name: str) -> str:
+        return os.path.join(self.entryPath(key), name + ".npy")
+
+    def load(self, key: str, name: str) -> Optional[np.ndarray]:
+        # Read only memory map of the cached volume, None when it is not cached
+        path = self.filePath(key, name)
+        if not os.path.exists(path):
+            return None
+        try:
+            array = np.load(path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            logging.warning(f"Discarding unreadable cache file {path}: {e}")
+            self.remove(key)
+            return None
+        self.touch(key)
+        return array
+
+    def save(self, key: str, name: str, array: np.ndarray):
+        with self.writer(key, name, array.shape, array.dtype) as write:
+            write(array)
+
+    @contextmanager
+    def writer(self, key: str, name: str, shape, dtype):
+        # Yields a function appending whole slices in C order, the file is only visible to load() once the
+        # block exits without error. Written sequentially, not memory mapped, so it can be renamed on Windows.
+        dtype = np.dtype(dtype)
+        os.makedirs(self.entryPath(key), exist_ok=True)
+        path = self.filePath(key, name)
+        temporaryPath = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temporaryPath, mode="wb") as f:
+                np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": tuple(int(d) for d in shape)})
+                yield lambda data: f.write(np.ascontiguousarray(data, dtype=dtype).data)
+            os.replace(temporaryPath, path)
+        except BaseException:
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+            if not os.listdir(self.entryPath(key)):
+                os.rmdir(self.entryPath(key))
+            raise
+        self.touch(key)
+        self.evict()
+
+    def touch(self, key: str):
+        now = time.time()
+        os.utime(self.entryPath(key), (now, now))
+
+    def remove(self, key: str):
+        shutil.rmtree(self.entryPath(key), ignore_errors=True)
+
+    def entries(self) -> list:
+        # (last use, bytes, key) of every entry
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self.entryPath(key)
+            if not os.path.isdir(path):
+                continue
+            # Files of an entry may be renamed or removed by another writer while it is listed
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+                entries.append((os.path.getmtime(path), size, key))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def evict(self):
+        with self.evictLock:
+            entries = sorted(self.entries())
+            totalBytes = sum(size for _, size, _ in entries)
+            # The most recently used entry is kept even when it is larger than the cache
+            for _, size, key in entries[:-1]:
+                if totalBytes <= self.maxBytes:
+                    break
+                self.remove(key)
+                totalBytes -= size
+
+    def clear(self):
+        for _, _, key in self.entries():
+            self.remove(key)
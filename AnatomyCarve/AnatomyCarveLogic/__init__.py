@@ -2,5 +2,14 @@ from AnatomyCarveLogic.AnatomyCarveLogic import AnatomyCarveLogic
 from AnatomyCarveLogic.AnatomyCarveLogic import AnatomyCarveParameterNode
 from AnatomyCarveLogic.ComputeShader import ComputeShader
 from AnatomyCarveLogic.Texture import Texture #Texture2D, Texture3D
+from AnatomyCarveLogic.StorageBuffer import StorageBuffer
 from AnatomyCarveLogic.Context import Context
-from AnatomyCarveLogic.Mask import Mask
\ No newline at end of file
+from AnatomyCarveLogic.Mask import Mask
+from AnatomyCarveLogic.CarveTracker import CarveTracker
+from AnatomyCarveLogic.CarveTarget import CarveTarget
+from AnatomyCarveLogic.GpuTimer import GpuTimer
+from AnatomyCarveLogic.Profiler import Profiler
+from AnatomyCarveLogic.CpuCarver import CpuCarver
+from AnatomyCarveLogic.Benchmark import Benchmark
+from AnatomyCarveLogic.InteractionTrace import InteractionTrace
+from AnatomyCarveLogic.VolumeCache import VolumeCache
\ No newline at end of file
@@ -22,7 +22,6 @@
 #include <vtkMRMLScene.h>
 
 // VTK includes
-#include <vtkIntArray.h>
 #include <vtkNew.h>
 #include <vtkObjectFactory.h>
 
@@ -75,6 +74,11 @@
 vtkStandardNewMacro(vtkSlicerVolumeTextureIDHelperLogic);
 
 int vtkSlicerVolumeTextureIDHelperLogic::GetTextureIdForMapper(vtkOpenGLGPUVolumeRayCastMapper* mapper, int portIndex)
+{
+    return GetTextureIdForMapper(mapper, nullptr, nullptr, portIndex);
+}
+
+int vtkSlicerVolumeTextureIDHelperLogic::GetTextureIdForMapper(vtkOpenGLGPUVolumeRayCastMapper* mapper, vtkRenderer* renderer, vtkVolume* volume, int portIndex)
 {
     auto it = mapper->AssembledInputs.find(portIndex);
     if (it == mapper->AssembledInputs.end())
@@ -84,24 +88,132 @@ int vtkSlicerVolumeTextureIDHelperLogic::GetTextureIdForMapper(vtkOpenGLGPUVolum
     }
     vtkVolumeInputHelper& helper = it->second;
     vtkVolumeTexture* volTex = helper.Texture;
-    auto* block = volTex->GetCurrentBlock();
-    if (!block)
-        block = volTex->GetNextBlock();
+    // GetNextBlock would advance the block traversal of the mapper, only the current block is read
+    auto* block = GetCurrentBlock(volTex, renderer, volume);
+    if (!block || !block->TextureObject)
+    {
+        std::cerr << "Volume texture has no block." << std::endl;
+        return -1;
+    }
     vtkTextureObject* texObj = block->TextureObject;
     return texObj->GetHandle();
 }
 
+int vtkSlicerVolumeTextureIDHelperLogic::IsTexturePartitionedForMapper(vtkOpenGLGPUVolumeRayCastMapper* mapper, vtkMRMLVolumeNode* volumeNode, int portIndex)
+{
+    return IsTexturePartitionedForMapper(mapper, nullptr, nullptr, volumeNode, portIndex);
+}
+
+int vtkSlicerVolumeTextureIDHelperLogic::IsTexturePartitionedForMapper(vtkOpenGLGPUVolumeRayCastMapper* mapper, vtkRenderer* renderer, vtkVolume* volume, vtkMRMLVolumeNode* volumeNode, int portIndex)
+{
+    auto it = mapper->AssembledInputs.find(portIndex);
+    if (it == mapper->AssembledInputs.end())
+    {
+        std::cerr << "portIndex not found." << std::endl;
+        return -1;
+    }
+    vtkVolumeTexture* volTex = it->second.Texture;
+    // Only reads the state of the texture: traversing the blocks would change what the mapper renders
+    const auto& partitions = volTex->GetPartitions();
+    if (partitions[0] * partitions[1] * partitions[2] > 1)
+    {
+        return 1;
+    }
+    auto* block = GetCurrentBlock(volTex, renderer, volume);
+    vtkImageData* imageData = volumeNode->GetImageData();
+    if (!block || !imageData)
+    {
+        std::cerr << "Volume texture has no block." << std::endl;
+        return -1;
+    }
+    // A single block streamed from a part of the image is partitioned as well
+    int* extent = imageData->GetExtent();
+    for (int i = 0; i < 6; ++i)
+    {
+        if (block->Extents[i] != extent[i])
+        {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+vtkVolumeTexture::VolumeBlock* vtkSlicerVolumeTextureIDHelperLogic::GetCurrentBlock(vtkVolumeTexture* volumeTexture, vtkRenderer* renderer, vtkVolume* volume)
+{
+    auto* block = volumeTexture->GetCurrentBlock();
+    const auto& partitions = volumeTexture->GetPartitions();
+    // Every render sorts the blocks before traversing them. With a single block the order is trivial, restarting
+    // the finished traversal does not change what the next render draws.
+    if (!block && renderer && volume && partitions[0] * partitions[1] * partitions[2] == 1)
+    {
+        volumeTexture->SortBlocksBackToFront(renderer, volume->GetMatrix());
+        block = volumeTexture->GetCurrentBlock();
+    }
+    return block;
+}
+
+int vtkSlicerVolumeTextureIDHelperLogic::SetSingleBlockForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex)
+{
+    vtkRenderer* renderer = nullptr;
+    vtkVolume* volume = nullptr;
+    vtkOpenGLGPUVolumeRayCastMapper* glMapper = FindMapperForVolume(volumeNode, threeDViewIndex, renderer, volume);
+    if (!glMapper)
+    {
+        return -1;
+    }
+    int partitioned = 0;
+    for (auto& input : glMapper->AssembledInputs)
+    {
+        const auto& partitions = input.second.Texture->GetPartitions();
+        if (partitions[0] * partitions[1] * partitions[2] > 1)
+        {
+            partitioned = 1;
+        }
+    }
+    glMapper->SetPartitions(1, 1, 1);
+    return partitioned;
+}
+
 int vtkSlicerVolumeTextureIDHelperLogic::GetTextureIdForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex)
 {
     return GetTextureIdForVolume(volumeNode, threeDViewIndex, 0);
 }
 
 int vtkSlicerVolumeTextureIDHelperLogic::GetTextureIdForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex, int portIndex)
+{
+    vtkRenderer* renderer = nullptr;
+    vtkVolume* volume = nullptr;
+    vtkOpenGLGPUVolumeRayCastMapper* glMapper = FindMapperForVolume(volumeNode, threeDViewIndex, renderer, volume);
+    if (!glMapper)
+    {
+        return -1;
+    }
+    return GetTextureIdForMapper(glMapper, renderer, volume, portIndex);
+}
+
+int vtkSlicerVolumeTextureIDHelperLogic::IsTexturePartitionedForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex)
+{
+    return IsTexturePartitionedForVolume(volumeNode, threeDViewIndex, 0);
+}
+
+int vtkSlicerVolumeTextureIDHelperLogic::IsTexturePartitionedForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex, int portIndex)
+{
+    vtkRenderer* renderer = nullptr;
+    vtkVolume* volume = nullptr;
+    vtkOpenGLGPUVolumeRayCastMapper* glMapper = FindMapperForVolume(volumeNode, threeDViewIndex, renderer, volume);
+    if (!glMapper)
+    {
+        return -1;
+    }
+    return IsTexturePartitionedForMapper(glMapper, renderer, volume, volumeNode, portIndex);
+}
+
+vtkOpenGLGPUVolumeRayCastMapper* vtkSlicerVolumeTextureIDHelperLogic::FindMapperForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex, vtkRenderer*& foundRenderer, vtkVolume*& foundVolume)
 {
     if (!volumeNode || !volumeNode->GetScene())
     {
         std::cerr << "volumeNode is empty." << std::endl;
-        return -1;
+        return nullptr;
     }
 
     //vtkMRMLScene* scene = volumeNode->GetScene();
@@ -152,33 +264,33 @@ int vtkSlicerVolumeTextureIDHelperLogic::GetTextureIdForVolume(vtkMRMLVolumeNode
     if (!layoutManager)
     {
         std::cerr << "Layout manager is not available." << std::endl;
-        return -1;
+        return nullptr;
     }
 
     int viewCount3d = layoutManager->threeDViewCount();
     if (threeDViewIndex < 0)
     {
         std::cerr << "viewIndex provided is negative." << std::endl;
-        return -1;
+        return nullptr;
     }
     else if (threeDViewIndex >= viewCount3d)
     {
         std::cerr << "viewIndex is higher than the number of 3D views." << std::endl;
-        return -1;
+        return nullptr;
     }
 
     qMRMLThreeDWidget* widget = layoutManager->threeDWidget(threeDViewIndex);
     if (!widget)
     {
         std::cerr << "  Failed to get threeDWidget." << std::endl;
-        return -1;
+        return nullptr;
     }
 
     qMRMLThreeDView* view = widget->threeDView();
     if (!view)
     {
         std::cerr << "  Failed to get threeDView." << std::endl;
-        return -1;
+        return nullptr;
     }
     
     vtkRenderWindow* renderWindow = view->renderWindow();
@@ -187,7 +299,7 @@ int vtkSlicerVolumeTextureIDHelperLogic::GetTextureIdForVolume(vtkMRMLVolumeNode
     if (!renderer)
     {
         std::cerr << "  No renderer found." << std::endl;
-        return -1;
+        return nullptr;
     }
 
 
@@ -227,7 +339,9 @@ int vtkSlicerVolumeTextureIDHelperLogic::GetTextureIdForVolume(vtkMRMLVolumeNode
             //    continue;
             //}
 
-            return GetTextureIdForMapper(glMapper, portIndex);
+            foundRenderer = renderer;
+            foundVolume = actor;
+            return glMapper;
 
             /*textureManager->
 
@@ -240,11 +354,11 @@ int vtkSlicerVolumeTextureIDHelperLogic::GetTextureIdForVolume(vtkMRMLVolumeNode
             }*/
         }
 
-        return -1;
+        return nullptr;
     }
 
     std::cerr << "No matching GPU volume mapper found for the specified volume node and 3D view." << std::endl;
-    return -1;
+    return nullptr;
 }
 
 //----------------------------------------------------------------------------
@@ -41,7 +41,10 @@
 #include <vtkOpenGLGPUVolumeRayCastMapper.h>
 
 #include <vtkSlicerVolumeRenderingLogic.h>
+#include <vtkVolumeTexture.h>
 
+class vtkRenderer;
+class vtkVolume;
 
 class VTK_SLICER_VOLUMETEXTUREIDHELPER_MODULE_LOGIC_EXPORT vtkSlicerVolumeTextureIDHelperLogic :
   public vtkSlicerModuleLogic
@@ -54,9 +57,23 @@ public:
 
   /// Gets the OpenGL texture ID used by the mapper in a specific view index
   int GetTextureIdForMapper(vtkOpenGLGPUVolumeRayCastMapper* mapper, int portIndex);
+  /// Same, the block traversal of a texture with a single block is restarted when a render finished it
+  int GetTextureIdForMapper(vtkOpenGLGPUVolumeRayCastMapper* mapper, vtkRenderer* renderer, vtkVolume* volume, int portIndex);
   int GetTextureIdForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex);
   int GetTextureIdForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex, int portIndex);
 
+  /// Returns 1 when VTK partitioned the texture used by the mapper into blocks (volumes larger than the
+  /// maximum 3D texture size or the memory budget, or partitions set on the mapper), 0 for a single texture
+  /// holding the whole volume and -1 on failure. The block traversal of the mapper is not changed.
+  int IsTexturePartitionedForMapper(vtkOpenGLGPUVolumeRayCastMapper* mapper, vtkMRMLVolumeNode* volumeNode, int portIndex);
+  int IsTexturePartitionedForMapper(vtkOpenGLGPUVolumeRayCastMapper* mapper, vtkRenderer* renderer, vtkVolume* volume, vtkMRMLVolumeNode* volumeNode, int portIndex);
+  int IsTexturePartitionedForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex);
+  int IsTexturePartitionedForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex, int portIndex);
+  /// Sets a single partition on the mapper rendering the volume in a 3D view, VTK loads the volume in one texture
+  /// the next time the image data is uploaded. Returns 1 when the texture was partitioned, 0 when it was not and
+  /// -1 on failure.
+  int SetSingleBlockForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex);
+
 protected:
   vtkSlicerVolumeTextureIDHelperLogic();
   ~vtkSlicerVolumeTextureIDHelperLogic() override;
@@ -67,6 +84,13 @@ protected:
   void UpdateFromMRMLScene() override;
   void OnMRMLSceneNodeAdded(vtkMRMLNode* node) override;
   void OnMRMLSceneNodeRemoved(vtkMRMLNode* node) override;
+
+  /// Finds the GPU ray cast mapper rendering the volume node in a 3D view, and makes its context current
+  vtkOpenGLGPUVolumeRayCastMapper* FindMapperForVolume(vtkMRMLVolumeNode* volumeNode, int threeDViewIndex, vtkRenderer*& renderer, vtkVolume*& volume);
+
+  /// Current block of the texture. A render leaves the traversal past the last block, it is restarted for a texture
+  /// with a single block when the renderer and the volume are given.
+  vtkVolumeTexture::VolumeBlock* GetCurrentBlock(vtkVolumeTexture* volumeTexture, vtkRenderer* renderer, vtkVolume* volume);
 private:
 
   vtkSlicerVolumeTextureIDHelperLogic(const vtkSlicerVolumeTextureIDHelperLogic&); // Not implemented